@@ -0,0 +1,256 @@
+"""
+datatools.compression
+~~~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import multiprocessing
+import struct
+import sys
+import threading
+import zlib
+import Queue
+
+from django.utils.encoding import smart_str
+
+try:
+    import bz2
+    has_bz2 = True
+except ImportError:
+    has_bz2 = False
+
+try:
+    import zstandard
+    has_zstd = True
+except ImportError:
+    has_zstd = False
+
+__all__ = ('CompressedWriter', 'ZstdFile', 'gzip_member', 'get_output_compression', 'has_bz2', 'has_zstd',
+           'WRITABLE_COMPRESSION')
+
+# Compression formats which ``CompressedWriter`` can write
+WRITABLE_COMPRESSION = ('gz', 'bz2', 'zst')
+
+
+def gzip_member(data, level=6):
+    """
+    Compresses ``data`` into a complete gzip member. A gzip file may hold any
+    number of members, which are decompressed as if they were one.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    # magic, deflate, no flags, no modification time, extra flags and an unknown OS
+    header = '\x1f\x8b\x08\x00\x00\x00\x00\x00%s\xff' % (level == 9 and '\x02' or level == 1 and '\x04' or '\x00')
+    return ''.join([header, body, struct.pack('<LL', zlib.crc32(data) & 0xffffffffL, len(data) & 0xffffffffL)])
+
+
+def get_output_compression(path):
+    """
+    Returns the compression format of a file at ``path`` judging by its
+    extension, or None if it is not compressed. Fixtures may also be zip
+    files, which ``CompressedWriter`` can't write (see ``WRITABLE_COMPRESSION``).
+    """
+    extension = path.rsplit('.', 1)[-1]
+    if extension in WRITABLE_COMPRESSION or extension == 'zip':
+        return extension
+    return None
+
+
+class _Block(object):
+    __slots__ = ('data', 'result', 'error', 'done')
+
+    def __init__(self, data):
+        self.data = data
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class CompressedWriter(object):
+    """
+    A file-like object which compresses what's written to it in the background,
+    so compression overlaps with producing the data.
+
+    Data is buffered into blocks of ``block_size`` bytes. With gzip, each block
+    is compressed into its own gzip member by a pool of ``threads`` threads
+    (defaulting to the number of CPUs, as zlib releases the GIL), and members
+    are written in order. bz2 and zstd blocks are fed to a single compressor
+    on a background thread, as Python 2 can only read single stream bz2 files.
+
+    >>> out = CompressedWriter(open('dump.json.gz', 'wb'), 'gz')
+    >>> out.write(data)
+    >>> out.close()
+    """
+
+    def __init__(self, fileobj, compression, block_size=1024 * 1024, threads=None, level=None):
+        if compression == 'gz':
+            level = level or 6
+            self.compress = lambda data: gzip_member(data, level)
+            self.compressobj = None
+            threads = threads or multiprocessing.cpu_count()
+        elif compression == 'bz2':
+            if not has_bz2:
+                raise ValueError('bz2 compression is not available')
+            self.compressobj = bz2.BZ2Compressor(level or 9)
+            threads = 0
+        elif compression == 'zst':
+            if not has_zstd:
+                raise ValueError('zstd compression requires the zstandard package')
+            self.compressobj = zstandard.ZstdCompressor(level=level or 3).compressobj()
+            threads = 0
+        else:
+            raise ValueError('Unknown compression format: %s' % compression)
+
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.written = False
+        self.closed = False
+        self.error = None
+        self.raised = False
+
+        # blocks waiting for a compression thread
+        self.work = Queue.Queue()
+        # blocks in the order they were written, bounded so that writing
+        # blocks while compression falls behind
+        self.blocks = Queue.Queue(max(threads, 1) * 2)
+
+        self.threads = [threading.Thread(target=self._compress) for n in xrange(threads)]
+        self.threads.append(threading.Thread(target=self._write))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _compress(self):
+        while True:
+            block = self.work.get()
+            if block is None:
+                return
+            try:
+                block.result = self.compress(block.data)
+            except Exception:
+                block.error = sys.exc_info()
+            block.data = None
+            block.done.set()
+
+    def _write(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            if self.error is not None:
+                # keep draining blocks so writers never wait on a full queue
+                continue
+            try:
+                if self.compressobj is not None:
+                    result = self.compressobj.compress(block.data)
+                else:
+                    block.done.wait()
+                    if block.error is not None:
+                        raise block.error[0], block.error[1], block.error[2]
+                    result = block.result
+                self.fileobj.write(result)
+            except Exception:
+                self.error = sys.exc_info()
+
+        if self.error is None and self.compressobj is not None:
+            try:
+                self.fileobj.write(self.compressobj.flush())
+            except Exception:
+                self.error = sys.exc_info()
+
+    def _raise(self):
+        if self.error is not None and not self.raised:
+            self.raised = True
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _submit(self, force=False):
+        """
+        Queues the buffered data a block of ``block_size`` bytes at a time,
+        keeping whatever is left over buffered unless ``force`` is set.
+        """
+        data = ''.join(self.buffer)
+        pos = 0
+        while len(data) - pos >= self.block_size or (force and (pos < len(data) or not self.written)):
+            self._raise()
+            block = _Block(data[pos:pos + self.block_size])
+            pos += self.block_size
+            self.written = True
+            if self.compressobj is None:
+                self.work.put(block)
+            self.blocks.put(block)
+        data = data[pos:]
+        self.buffer = data and [data] or []
+        self.buffered = len(data)
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        data = smart_str(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Compresses and writes anything still buffered, and closes the file.
+        Errors raised while compressing or writing are raised here if they
+        weren't raised by a previous ``write``.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(force=True)
+        finally:
+            self.blocks.put(None)
+            for thread in self.threads[:-1]:
+                self.work.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.fileobj.close()
+        self._raise()
+
+
+class ZstdFile(object):
+    """
+    Reads a zstd compressed file, for loading fixtures.
+    """
+
+    def __init__(self, path, mode='r'):
+        if not has_zstd:
+            raise ValueError('zstd compression requires the zstandard package')
+        self.fileobj = open(path, 'rb')
+        self.reader = zstandard.ZstdDecompressor().stream_reader(self.fileobj)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self.buffer + ''.join(iter(lambda: self.reader.read(65536), ''))
+            self.buffer = ''
+            return data
+        if not self.buffer:
+            return self.reader.read(size)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, *args):
+        while '\n' not in self.buffer:
+            data = self.reader.read(65536)
+            if not data:
+                break
+            self.buffer += data
+        pos = self.buffer.find('\n') + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:pos], self.buffer[pos:]
+        return line
+
+    def close(self):
+        self.reader.close()
+        self.fileobj.close()
@@ -0,0 +1,308 @@
+"""
+datatools.loaders
+~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import datetime
+import sys
+from StringIO import StringIO
+from collections import defaultdict
+
+from django.db import connections, transaction, IntegrityError, DatabaseError
+from django.db.models import AutoField
+
+__all__ = ('Loader', 'BulkLoader', 'NativeLoader', 'SQLiteLoader', 'PostgresLoader', 'get_loader',
+           'save_object')
+
+
+def save_object(obj, using):
+    """
+    Saves a ``DeserializedObject``, re-raising any database error with a message
+    that identifies the object which failed to load.
+    """
+    try:
+        obj.save(using=using)
+    except (DatabaseError, IntegrityError), e:
+        msg = "Could not load %(app_label)s.%(object_name)s(pk=%(pk)s): %(error_msg)s" % {
+                'app_label': obj.object._meta.app_label,
+                'object_name': obj.object._meta.object_name,
+                'pk': obj.object.pk,
+                'error_msg': e
+            }
+        raise e.__class__, e.__class__(msg), sys.exc_info()[2]
+
+
+def refers_to_itself(model):
+    """
+    Returns True if ``model`` has a ForeignKey or ManyToManyField to itself.
+    """
+    return any(getattr(f.rel, 'to', None) is model for f in model._meta.fields + model._meta.many_to_many)
+
+
+class Loader(object):
+    """
+    Saves deserialized objects to the database one at a time.
+    """
+
+    def __init__(self, using):
+        self.using = using
+
+    def load(self, obj):
+        save_object(obj, self.using)
+
+    def expect(self, model):
+        """
+        Called with the model of the next object, or None if it isn't known,
+        before it is deserialized (which resolves its natural keys against
+        the database).
+        """
+        pass
+
+    def flush(self):
+        pass
+
+    def clear(self):
+        """
+        Discards any objects which have not been written yet.
+        """
+        pass
+
+    def begin(self):
+        """
+        Prepares the connection for loading, before the transaction objects are
+        loaded in has begun. This is only called if loading is not part of a
+        larger transaction.
+        """
+        pass
+
+    def close(self):
+        """
+        Undoes any changes made by ``begin``, once the transaction objects
+        were loaded in has ended.
+        """
+        pass
+
+
+class BulkLoader(Loader):
+    """
+    Buffers deserialized objects by model and inserts them ``batch_size`` at a
+    time using ``bulk_create``. Many to many relations are inserted into their
+    intermediary tables in bulk once the objects themselves are written.
+
+    No signals are sent for objects loaded in bulk. If a batch fails to insert
+    (for example because some of the rows already exist) it is rolled back and
+    saved an object at a time instead, which also reports the offending object.
+
+    Objects without a primary key are saved through the ORM straight away, as
+    ``bulk_create`` doesn't set the primary keys their relations need.
+
+    Natural keys are resolved against the database as objects are deserialized,
+    so batches of models with natural keys are written before the next object
+    is deserialized, unless it is of the same model (and that model doesn't
+    refer to itself).
+    """
+
+    def __init__(self, using, batch_size=500):
+        super(BulkLoader, self).__init__(using)
+        self.batch_size = batch_size
+        self.pending = defaultdict(list)
+
+    def load(self, obj):
+        model = obj.object.__class__
+        # Inherited models span multiple tables, which bulk_create can't handle
+        if model._meta.parents or obj.object.pk is None:
+            save_object(obj, self.using)
+            return
+
+        pending = self.pending[model]
+        pending.append(obj)
+        if len(pending) >= self.batch_size:
+            self.flush_model(model)
+
+    def expect(self, model):
+        for pending in self.pending.keys():
+            if not hasattr(pending._default_manager, 'get_by_natural_key'):
+                continue
+            if pending is model and not refers_to_itself(model):
+                continue
+            self.flush_model(pending)
+
+    def flush(self):
+        for model in self.pending.keys():
+            self.flush_model(model)
+
+    def clear(self):
+        self.pending.clear()
+
+    def flush_model(self, model):
+        objects = self.pending.pop(model, [])
+        if not objects:
+            return
+
+        sid = transaction.savepoint(using=self.using)
+        try:
+            self.insert(model, objects)
+        except (DatabaseError, IntegrityError):
+            transaction.savepoint_rollback(sid, using=self.using)
+            for obj in objects:
+                save_object(obj, self.using)
+        else:
+            transaction.savepoint_commit(sid, using=self.using)
+
+    def insert(self, model, objects):
+        """
+        Inserts ``objects`` and their many to many relations.
+        """
+        model._base_manager.db_manager(self.using).bulk_create([o.object for o in objects])
+        for through, rows in self.get_m2m_rows(model, objects).iteritems():
+            through._base_manager.db_manager(self.using).bulk_create(rows)
+
+    def get_m2m_rows(self, model, objects):
+        """
+        Returns a mapping of intermediary models to the (unsaved) rows needed to
+        represent the many to many data of ``objects``.
+        """
+        rows = defaultdict(list)
+        for obj in objects:
+            for field_name, pks in obj.m2m_data.iteritems():
+                field = model._meta.get_field(field_name)
+                through = field.rel.through
+                source = through._meta.get_field(field.m2m_field_name()).attname
+                target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+                for pk in pks:
+                    rows[through].append(through(**{source: obj.object.pk, target: pk}))
+        return rows
+
+
+class NativeLoader(BulkLoader):
+    """
+    Buffers deserialized objects like ``BulkLoader``, but writes them to their
+    tables with the database's own bulk loading mechanism, bypassing the ORM.
+
+    This is a base class: subclasses define ``insert_rows(table, columns, rows)``,
+    which writes ``rows`` (lists of values prepared as they would be for a raw
+    ``save``) to the given columns of ``table``.
+    """
+
+    def insert(self, model, objects):
+        self.insert_objects(model, [o.object for o in objects])
+        for through, rows in self.get_m2m_rows(model, objects).iteritems():
+            self.insert_objects(through, rows)
+
+    def insert_objects(self, model, objects):
+        connection = connections[self.using]
+        # Rows of intermediary tables don't come with a primary key
+        fields = [f for f in model._meta.local_fields
+                  if not (isinstance(f, AutoField) and objects[0].pk is None)]
+        rows = [[f.get_db_prep_save(getattr(obj, f.attname), connection=connection) for f in fields]
+                for obj in objects]
+        self.insert_rows(model._meta.db_table, [f.column for f in fields], rows)
+
+
+class SQLiteLoader(NativeLoader):
+    """
+    Inserts rows with a single ``executemany`` per batch, having relaxed the
+    durability guarantees of the connection for the duration of the load.
+
+    Pragmas can't be set within a transaction (the sqlite3 module commits it
+    first), so they're only set in ``begin``.
+    """
+    pragmas = (
+        ('synchronous', 'OFF'),
+        ('temp_store', 'MEMORY'),
+        ('cache_size', '10000'),
+    )
+
+    def __init__(self, using, batch_size=500):
+        super(SQLiteLoader, self).__init__(using, batch_size)
+        self.previous_pragmas = None
+
+    def set_pragmas(self, pragmas):
+        cursor = connections[self.using].cursor()
+        for name, value in pragmas:
+            try:
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+            except DatabaseError:
+                pass
+
+    def begin(self):
+        cursor = connections[self.using].cursor()
+        self.previous_pragmas = []
+        for name, value in self.pragmas:
+            cursor.execute('PRAGMA %s' % name)
+            self.previous_pragmas.append((name, cursor.fetchone()[0]))
+        self.set_pragmas(self.pragmas)
+
+    def insert_rows(self, table, columns, rows):
+        connection = connections[self.using]
+        qn = connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(table), ', '.join(qn(c) for c in columns),
+                                                   ', '.join(['%s'] * len(columns)))
+        connection.cursor().executemany(sql, rows)
+
+    def close(self):
+        if self.previous_pragmas is not None:
+            self.set_pragmas(self.previous_pragmas)
+            self.previous_pragmas = None
+
+
+def copy_value(value):
+    """
+    Formats a value for the text format of PostgreSQL's ``COPY``.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return value and 't' or 'f'
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        value = value.isoformat()
+    elif not isinstance(value, basestring):
+        value = unicode(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class PostgresLoader(NativeLoader):
+    """
+    Streams rows into each table with ``COPY ... FROM STDIN``.
+    """
+
+    def insert_rows(self, table, columns, rows):
+        connection = connections[self.using]
+        stream = StringIO()
+        for row in rows:
+            stream.write('\t'.join(copy_value(v) for v in row))
+            stream.write('\n')
+        stream.seek(0)
+
+        qn = connection.ops.quote_name
+        sql = 'COPY %s (%s) FROM STDIN' % (qn(table), ', '.join(qn(c) for c in columns))
+        # COPY is only available on psycopg2's own cursor
+        cursor = connection.cursor()
+        getattr(cursor, 'cursor', cursor).copy_expert(sql, stream)
+
+
+NATIVE_LOADERS = {
+    'sqlite': SQLiteLoader,
+    'postgresql': PostgresLoader,
+}
+
+
+def get_loader(using, engine='orm', bulk=False, batch_size=500):
+    """
+    Returns the loader for ``engine``, which is either ``orm`` (saving objects
+    one at a time, or in batches if ``bulk`` is set) or ``native``. Backends
+    without a native loader fall back to loading in batches with the ORM.
+    """
+    if engine == 'native':
+        loader = NATIVE_LOADERS.get(connections[using].vendor, BulkLoader)
+        return loader(using, batch_size=batch_size)
+    if engine != 'orm':
+        raise ValueError("Unknown engine: %s" % engine)
+    if bulk:
+        return BulkLoader(using, batch_size=batch_size)
+    return Loader(using)
@@ -9,15 +9,27 @@ datatools.management.commands.dumpdata
 from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand, CommandError
 from django.core import serializers
-from django.db import router, DEFAULT_DB_ALIAS
-from django.db.models import ForeignKey
+from django.db import connections, router, DEFAULT_DB_ALIAS
+from django.db.models import AutoField, Count, ForeignKey, IntegerField, Max, Min
+from django.utils.encoding import smart_unicode
 
+import cPickle
+import heapq
 import itertools
+import multiprocessing
+import os
+import tempfile
 from optparse import make_option
 from collections import defaultdict
 
+from datatools.compression import CompressedWriter, get_output_compression, has_bz2, has_zstd, \
+  WRITABLE_COMPRESSION
+from datatools.query import RangeQuerySetWrapper
+from datatools.serializers import get_streaming_serializer
+from datatools.utils import chunked, close_connections, is_in_memory, split_range
 
-def objects_from_queryset(queryset, using='default'):
+
+def objects_from_queryset(queryset, using='default', batch_size=500, seen=None, **walk):
     """
     Serializes objects from the database.
 
@@ -25,48 +37,300 @@ def objects_from_queryset(queryset, using='default'):
     limit and sort the apps that you're pulling in, as well as automatically follow
     the dependency graph to pull in related objects.
     """
-    # Now collate the objects to be serialized.
-    objects = []
-
     if using:
         queryset = queryset.using(using)
 
-    results = list(queryset)
+    return collect_objects(queryset, using=using, seen=seen, batch_size=batch_size, **walk)
+
+
+def collect_objects(instances, using='default', seen=None, batch_size=500, max_depth=None,
+                    max_rows=None, follow=None, written=None):
+    """
+    Given a list of instances, returns them along with every object they
+    depend on through ForeignKeys and ManyToManyFields.
+
+    Related objects are fetched with ``IN`` queries of at most ``batch_size``
+    values, to stay within the limits of backends such as SQLite and MySQL.
+
+    Objects are tracked by ``(model, pk)`` rather than compared against each
+    other. If ``seen`` is passed, any object whose key is already in it is
+    skipped, and the keys of all returned objects are added to it. Given
+    ``written(model, pks)``, which returns those of ``pks`` that were written
+    without being added to ``seen``, those objects are skipped as well.
+
+    Dependencies are collected breadth first, and the walk can be cut short:
+    relations are only followed ``max_depth`` levels away from ``instances``,
+    no more objects are collected once ``seen`` holds ``max_rows`` of them,
+    and only the fields for which ``follow(field)`` is true are followed.
+    """
+    if seen is None:
+        seen = set()
+
+    def unseen(objs):
+        results = []
+        for obj in objs:
+            if max_rows is not None and len(seen) >= max_rows:
+                break
+            key = (obj.__class__, obj.pk)
+            if key not in seen:
+                seen.add(key)
+                results.append(obj)
+        return results
+
+    def unwritten(objs):
+        if written is None or not objs:
+            return objs
+        found = written(objs[0].__class__, set(obj.pk for obj in objs))
+        return [obj for obj in objs if obj.pk not in found]
+
+    # Now collate the objects to be serialized.
+    results = unseen(instances)
     if not results:
         return []
 
-    objs_to_check = [results[:]]
+    objs_to_check = [(results[:], 0)]
     while objs_to_check:
-        i_objs = objs_to_check.pop(0)
+        i_objs, depth = objs_to_check.pop(0)
+        if max_depth is not None and depth >= max_depth:
+            continue
+        if max_rows is not None and len(seen) >= max_rows:
+            break
         i_model = i_objs[0].__class__
 
         # Handle O2M dependencies
         for field in (f for f in i_model._meta.fields if isinstance(f, ForeignKey)):
-            qs = field.rel.to._default_manager
+            if follow is not None and not follow(field):
+                continue
+            model = field.rel.to
+            lookup = field.rel.field_name
+            # Only values referencing the primary key can be checked against
+            # what we've already collected
+            is_pk = lookup == model._meta.pk.name
+
+            values, found = [], set()
+            for value in (getattr(r, field.column) for r in i_objs):
+                if value is None or value in found or (is_pk and (model, value) in seen):
+                    continue
+                found.add(value)
+                values.append(value)
+            if is_pk and written is not None and values:
+                found = written(model, values)
+                values = [v for v in values if v not in found]
+
+            qs = model._default_manager
             if using:
                 qs = qs.using(using)
-            i_res = [o for o
-                     in qs.filter(pk__in=[getattr(r, field.column) for r in i_objs])
-                     if o not in results]
+            i_res = []
+            for i_values in chunked(values, batch_size):
+                i_res.extend(unseen(qs.filter(**{'%s__in' % lookup: i_values})))
             if i_res:
-                objs_to_check.append(i_res)
+                objs_to_check.append((i_res, depth + 1))
                 results.extend(i_res)
 
-        # Handle M2M dependencies
-        # TODO: this could be a lot more efficient on the SQL query
+        # Handle M2M dependencies, pulling in the related objects with a single
+        # query against the intermediary table per ``batch_size`` objects
         for field in i_model._meta.many_to_many:
-            i_res = [o for o
-                     in itertools.chain(*[getattr(r, field.name).all() for r in i_objs])
-                     if o not in results]
+            if follow is not None and not follow(field):
+                continue
+            through = field.rel.through
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            qs = through._default_manager
+            if using:
+                qs = qs.using(using)
+            qs = qs.select_related(target)
+            rows = []
+            for pks in chunked([r.pk for r in i_objs], batch_size):
+                rows.extend(qs.filter(**{'%s__in' % source: pks}))
+
+            # Auto created intermediary models are serialized as part of the
+            # objects themselves, but explicit ones need to be dumped as well
+            if not through._meta.auto_created:
+                i_res = unseen(unwritten(rows))
+                if i_res:
+                    objs_to_check.append((i_res, depth + 1))
+                    results.extend(i_res)
+
+            i_res = unseen(unwritten([getattr(row, target) for row in rows]))
             if i_res:
-                objs_to_check.append(i_res)
+                objs_to_check.append((i_res, depth + 1))
                 results.extend(i_res)
 
-    for obj in results:
-        if obj not in objects:
-            objects.append(obj)
+    return results
+
+
+def filter_pks(queryset, pks, batch_size=500):
+    """
+    Returns those of ``pks`` which are the primary keys of rows in ``queryset``,
+    querying for at most ``batch_size`` of them at a time.
+    """
+    found = set()
+    for values in chunked(sorted(pks), batch_size):
+        found.update(queryset.filter(pk__in=values).values_list('pk', flat=True))
+    return found
+
+
+def clear_missing_references(objects, seen, pending=None):
+    """
+    Clears the nullable ForeignKeys of ``objects`` which reference an object
+    whose key is not in ``seen``, i.e. one that was left out of a dump.
+
+    When streaming, objects which are still to be written aren't in ``seen``
+    yet. Given ``pending(model, pks)``, which returns those of ``pks`` that
+    will be written later on, references to them are left alone.
+    """
+    missing = []
+    for obj in objects:
+        for field in obj._meta.fields:
+            if not isinstance(field, ForeignKey) or not field.null:
+                continue
+            model = field.rel.to
+            if field.rel.field_name != model._meta.pk.name:
+                continue
+            value = getattr(obj, field.column)
+            if value is not None and (model, value) not in seen:
+                missing.append((obj, field, model, value))
+
+    kept = set()
+    if pending is not None and missing:
+        by_model = defaultdict(set)
+        for obj, field, model, value in missing:
+            by_model[model].add(value)
+        for model, values in by_model.iteritems():
+            kept.update((model, value) for value in pending(model, values))
+
+    for obj, field, model, value in missing:
+        if (model, value) not in kept:
+            setattr(obj, field.attname, None)
+
+
+def edge_filter(include=(), exclude=()):
+    """
+    Returns a function which given a relation field returns whether to follow
+    it, based on ``app_label.model.field`` labels. Once a model has any of its
+    fields included, only those are followed.
+    """
+    from django.db.models import get_model
+    from django.db.models.fields import FieldDoesNotExist
+
+    def normalize(label):
+        # model names are case insensitive, as they are for --filter
+        try:
+            app_label, model_label, field_name = label.split('.')
+        except ValueError:
+            raise CommandError("Invalid edge: %s" % label)
+        model = get_model(app_label, model_label)
+        if model is None:
+            raise CommandError("Unknown model: %s.%s" % (app_label, model_label))
+        try:
+            model._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            raise CommandError("Unknown field: %s" % label)
+        return '%s.%s.%s' % (model._meta.app_label, model._meta.object_name.lower(), field_name)
+
+    include, exclude = set(map(normalize, include)), set(map(normalize, exclude))
+    included_models = set(label.rsplit('.', 1)[0] for label in include)
+
+    def follow(field):
+        model = '%s.%s' % (field.model._meta.app_label, field.model._meta.object_name.lower())
+        label = '%s.%s' % (model, field.name)
+        if label in exclude:
+            return False
+        return model not in included_models or label in include
+    return follow
+
+
+def parse_filters(filters):
+    """
+    Parses ``app_label.ModelName:field=value,field=value`` expressions into a
+    mapping of models to lookups.
+    """
+    from django.db.models import get_model
+
+    results = defaultdict(dict)
+    for expression in filters:
+        try:
+            label, lookups = expression.split(':', 1)
+            app_label, model_label = label.split('.')
+            lookups = dict(lookup.split('=', 1) for lookup in lookups.split(','))
+        except ValueError:
+            raise CommandError("Invalid filter: %s" % expression)
+        model = get_model(app_label, model_label)
+        if model is None:
+            raise CommandError("Unknown model: %s.%s" % (app_label, model_label))
+        results[model].update((str(k), v) for k, v in lookups.iteritems())
+    return results
+
+
+def dump_shard(task):
+    """
+    Collects a model (or a range of its primary keys) along with its
+    dependencies, and writes the objects in their ``python`` serialized form
+    to one temporary file per model.
 
-    return objects
+    This is run in worker processes when dumping with ``--jobs``, and returns
+    a list of ``(model label, path)`` pairs for the parent to merge.
+    """
+    from django.db.models import get_model
+
+    using = task['using']
+    chunk_size = task['chunk_size']
+
+    model = get_model(*task['model'].split('.'))
+    queryset = model._default_manager
+    if using:
+        queryset = queryset.using(using)
+    queryset = queryset.all()
+
+    min_id, max_id = task['range']
+    if min_id is not None:
+        queryset = queryset.filter(pk__gte=min_id, pk__lte=max_id)
+
+    if task['sort'] == 'desc':
+        step = -chunk_size
+    else:
+        step = chunk_size
+
+    seen = set()
+    files = {}
+    try:
+        for chunk in chunked(RangeQuerySetWrapper(queryset, step=step, limit=task['limit']), chunk_size):
+            objects = collect_objects(chunk, using, seen, task['batch_size'])
+            for data in serializers.serialize('python', objects,
+                            use_natural_keys=task['use_natural_keys']):
+                if data['model'] not in files:
+                    fd, path = tempfile.mkstemp(prefix='dumpdata-', suffix='.pickle')
+                    files[data['model']] = (os.fdopen(fd, 'wb'), path)
+                cPickle.dump(data, files[data['model']][0], cPickle.HIGHEST_PROTOCOL)
+    except:
+        for fp, path in files.itervalues():
+            fp.close()
+            os.unlink(path)
+        raise
+
+    for fp, path in files.itervalues():
+        fp.close()
+
+    return [(label, path) for label, (fp, path) in files.iteritems()]
+
+
+def read_fragment(path):
+    """
+    Yields the objects written to a fragment by ``dump_shard``.
+    """
+    fp = open(path, 'rb')
+    try:
+        while True:
+            try:
+                yield cPickle.load(fp)
+            except EOFError:
+                break
+    finally:
+        fp.close()
+
+
+def _run_task(args):
+    index, task = args
+    return index, dump_shard(task)
 
 
 class Command(BaseCommand):
@@ -86,6 +350,31 @@ class Command(BaseCommand):
             help='Limit the number of objects per app.'),
         make_option('-s', '--sort', dest='sort', default=None,
             help='Change the sort order (useful with limit). Defaults to no sorting. Options are \'asc\' and \'desc\''),
+        make_option('--stream', action='store_true', dest='stream', default=False,
+            help='Write objects out as they are fetched instead of collecting the entire dump in memory.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+            help='Number of objects per model to fetch at a time when streaming. Defaults to 1000.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help='Maximum number of values in a single IN query when following dependencies. Defaults to 500.'),
+        make_option('-o', '--output', dest='output', default=None,
+            help='Specifies a file to write the serialized data to. Defaults to standard output. Files '
+                 'ending in .gz, .bz2 or .zst are compressed on background threads as they are written.'),
+        make_option('-j', '--jobs', dest='jobs', type='int', default=1,
+            help='Number of worker processes to dump models with. Models larger than --chunk-size are '
+                 'split into primary key ranges. Defaults to 1.'),
+        make_option('--filter', action='append', dest='filters', default=[],
+            help='Only dump the objects of a model matching the given lookups, and their dependencies '
+                 '(e.g. forums.Thread:forum=1,id__gt=1000). Use multiple --filter to filter more models.'),
+        make_option('--depth', dest='max_depth', type='int', default=None,
+            help='Only follow relations this many levels away from the objects being dumped.'),
+        make_option('--max-rows', dest='max_rows', type='int', default=None,
+            help='Stop collecting objects once this many have been collected.'),
+        make_option('--include-edge', action='append', dest='include_edges', default=[],
+            help='Only follow the given relations (app_label.model.field) of their model. '
+                 'Use multiple --include-edge to follow more relations.'),
+        make_option('--exclude-edge', action='append', dest='exclude_edges', default=[],
+            help='Never follow the given relation (app_label.model.field). '
+                 'Use multiple --exclude-edge to exclude more relations.'),
     )
     help = 'Output the contents of the database as a fixture of the given format.'
     args = '[appname appname.ModelName ...]'
@@ -138,11 +427,13 @@ class Command(BaseCommand):
                     model_list.update(get_models(app))
         return model_list
 
-    def _get_query_set(self, model, sort=None, using=None):
+    def _get_query_set(self, model, sort=None, using=None, filters=None):
         qs = model._default_manager
         if using:
             qs = qs.using(using)
         qs = qs.all()
+        if filters and model in filters:
+            qs = qs.filter(**filters[model])
 
         if sort == 'desc':
             qs = qs.order_by('-pk')
@@ -158,6 +449,182 @@ class Command(BaseCommand):
             return False
         return True
 
+    def _iter_objects(self, model_list, limit=None, sort=None, using=None, chunk_size=1000,
+                      batch_size=500, filters=None, seen=None, **walk):
+        """
+        Yields every object to be serialized in dependency order, never holding
+        more than ``chunk_size`` rows of a model (plus their dependencies) in
+        memory at once.
+
+        Rows of the models in ``model_list`` aren't remembered once written, as
+        whether a row was written follows from how far the walk of its model
+        got (and its filter). Only the keys of the dependencies written ahead
+        of (or instead of) their own model are kept in ``seen``, so that they
+        aren't written twice. With ``max_rows`` every key is kept, as there
+        are never more than ``max_rows`` of them.
+
+        References which aren't followed are only cleared if they can't be
+        written later on, by a chunk of the model being walked or by a model
+        which is still to come. With ``max_rows`` the dump may stop before
+        then, so only what has been written counts.
+        """
+        if seen is None:
+            seen = set()
+        limited = any(v is not None for v in walk.itervalues())
+        max_rows = walk.get('max_rows')
+        models = [m for m in sort_models(model_list) if self._can_dump_model(m, using)]
+        remaining = set(models)
+        bounds = {}
+        # the primary key each model has been walked up to
+        walked = {}
+        if sort == 'desc':
+            step, upto = -chunk_size, 'pk__gte'
+        else:
+            step, upto = chunk_size, 'pk__lte'
+
+        def is_filtered(model):
+            return bool(filters) and model in filters
+
+        def written(model, pks):
+            if model not in walked:
+                return set()
+            cursor = walked[model]
+            if not is_filtered(model) and isinstance(model._meta.pk, (AutoField, IntegerField)):
+                return set(pk for pk in pks if (step < 0 and pk >= cursor) or (step > 0 and pk <= cursor))
+            queryset = self._get_query_set(model, using=using, filters=filters).filter(**{upto: cursor})
+            return filter_pks(queryset, pks, batch_size)
+
+        def pending(model, pks):
+            if model not in remaining:
+                return set()
+            if not limit and not is_filtered(model):
+                return set(pks)
+            queryset = self._get_query_set(model, using=using, filters=filters)
+            if limit:
+                # the last row the limit lets through
+                if model not in bounds:
+                    ordered = queryset.order_by(step < 0 and '-pk' or 'pk')
+                    bounds[model] = list(ordered.values_list('pk', flat=True)[limit - 1:limit])
+                if bounds[model]:
+                    queryset = queryset.filter(**{upto: bounds[model][0]})
+            return filter_pks(queryset, pks, batch_size)
+
+        def present(model, pks):
+            return written(model, pks) | pending(model, pks)
+
+        for model in models:
+            queryset = self._get_query_set(model, using=using, filters=filters)
+            for chunk in chunked(RangeQuerySetWrapper(queryset, step=step, limit=limit), chunk_size):
+                if max_rows is not None:
+                    objects = collect_objects(chunk, using, seen, batch_size, **walk)
+                    if limited:
+                        clear_missing_references(objects, seen)
+                else:
+                    walked[model] = chunk[-1].pk
+                    objects = collect_objects(chunk, using, seen, batch_size, written=written, **walk)
+                    # from here on these are told apart by how far the walk got
+                    seen.difference_update((model, obj.pk) for obj in chunk)
+                    if limited:
+                        clear_missing_references(objects, seen, present)
+                for obj in sort_dependencies(objects):
+                    yield obj
+                if max_rows is not None and len(seen) >= max_rows:
+                    return
+            remaining.discard(model)
+
+            if model in walked and not limit and not is_filtered(model):
+                # every row of the model has been written
+                seen.difference_update([key for key in seen if key[0] is model])
+
+    def _get_tasks(self, model_list, jobs, limit=None, sort=None, using=None, chunk_size=1000,
+                   batch_size=500, use_natural_keys=False):
+        """
+        Returns the list of work to be handed out to ``dump_shard``, with one task
+        per model, or per range of primary keys for models with integer keys
+        that are larger than ``chunk_size``.
+        """
+        tasks = []
+        for model in sort_models(model_list):
+            if not self._can_dump_model(model, using):
+                continue
+
+            ranges = [(None, None)]
+            # Limits apply to the model as a whole, so those cannot be split up
+            if not limit and isinstance(model._meta.pk, (AutoField, IntegerField)):
+                stats = self._get_query_set(model, using=using).aggregate(
+                    min_id=Min('pk'), max_id=Max('pk'), count=Count('pk'))
+                if stats['count'] > chunk_size:
+                    ranges = split_range(stats['min_id'], stats['max_id'], jobs)
+                    if sort == 'desc':
+                        ranges.reverse()
+
+            for pk_range in ranges:
+                tasks.append({
+                    'model': smart_unicode(model._meta),
+                    'range': pk_range,
+                    'limit': limit,
+                    'sort': sort,
+                    'using': using,
+                    'chunk_size': chunk_size,
+                    'batch_size': batch_size,
+                    'use_natural_keys': use_natural_keys,
+                })
+        return tasks
+
+    def _dump_parallel(self, tasks, jobs):
+        """
+        Runs ``tasks`` across ``jobs`` worker processes, returning the resulting
+        fragments in the order of the tasks which produced them.
+        """
+        close_connections()
+
+        results = {}
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for index, fragments in pool.imap_unordered(_run_task, enumerate(tasks)):
+                results[index] = fragments
+            pool.close()
+        except:
+            pool.terminate()
+            for fragments in results.itervalues():
+                for label, path in fragments:
+                    os.unlink(path)
+            raise
+        finally:
+            pool.join()
+
+        return [f for index in sorted(results) for f in results[index]]
+
+    def _merge_fragments(self, fragments):
+        """
+        Yields the objects of all fragments, grouped by model in dependency order,
+        skipping any object that was collected by more than one worker.
+        """
+        from django.db.models import get_model
+
+        by_model = defaultdict(list)
+        for label, path in fragments:
+            by_model[label].append(path)
+
+        seen = set()
+        for model in sort_models([get_model(*label.split('.')) for label in by_model]):
+            label = smart_unicode(model._meta)
+            objects = (data for path in by_model[label] for data in read_fragment(path))
+            # rows may reference rows dumped by another worker, so we have to
+            # hold on to all of them to put parents first
+            fields = [f.name for f in get_self_references(model)]
+            if fields:
+                # (natural keys can't reference a primary key)
+                objects = sort_rows(list(objects), lambda d: d['pk'],
+                                    lambda d: [d['fields'][f] for f in fields
+                                               if not isinstance(d['fields'][f], list)])
+            for data in objects:
+                if data['pk'] in seen:
+                    continue
+                seen.add(data['pk'])
+                yield data
+            seen.clear()
+
     def handle(self, *app_labels, **options):
         """
         Serializes objects from the database.
@@ -175,7 +642,26 @@ class Command(BaseCommand):
         exclude = options.get('exclude', [])
         show_traceback = options.get('traceback', True)
         use_natural_keys = options.get('use_natural_keys', False)
-
+        stream = options.get('stream', False)
+        chunk_size = options.get('chunk_size', 1000)
+        batch_size = options.get('batch_size', 500)
+        output = options.get('output', None)
+        jobs = options.get('jobs', 1)
+        filters = parse_filters(options.get('filters', []))
+        include_edges = options.get('include_edges', [])
+        exclude_edges = options.get('exclude_edges', [])
+        walk = {
+            'max_depth': options.get('max_depth', None),
+            'max_rows': options.get('max_rows', None),
+            'follow': None,
+        }
+        if include_edges or exclude_edges:
+            walk['follow'] = edge_filter(include_edges, exclude_edges)
+        limited = any(v is not None for v in walk.itervalues())
+
+        # Filtered models are the ones to dump, unless told otherwise
+        if filters and not app_labels:
+            app_labels = ['%s.%s' % (m._meta.app_label, m._meta.object_name) for m in filters]
         model_list = self._get_model_list(app_labels, exclude)
 
         # Check that the serialization format exists; this is a shortcut to
@@ -185,25 +671,81 @@ class Command(BaseCommand):
         except KeyError:
             raise CommandError("Unknown serialization format: %s" % format)
 
-        # Now collate the objects to be serialized.
-        objects = []
-        for model in model_list:
-            if not self._can_dump_model(model, using):
-                continue
+        if jobs > 1:
+            if limited or filters:
+                raise CommandError("Parallel dumps can't be limited with --filter, --depth, --max-rows "
+                                   "or edge rules")
+            if not hasattr(get_streaming_serializer(format), 'serialize_python'):
+                raise CommandError("Parallel dumps are not supported for the %s format" % format)
+            connection = connections[using or DEFAULT_DB_ALIAS]
+            if is_in_memory(connection):
+                raise CommandError("Parallel dumps are not supported for in-memory databases")
+
+        compression = output and get_output_compression(output)
+        if compression and compression not in WRITABLE_COMPRESSION:
+            raise CommandError("Unable to write %s compressed files" % compression)
+        if compression == 'bz2' and not has_bz2:
+            raise CommandError("bz2 compression is not available")
+        if compression == 'zst' and not has_zstd:
+            raise CommandError("zstd compression requires the zstandard package")
+
+        if compression:
+            out = CompressedWriter(open(output, 'wb'), compression)
+        elif output:
+            out = open(output, 'w')
+        else:
+            out = self.stdout
 
-            queryset = self._get_query_set(model, sort, using)[:limit]
+        try:
+            if jobs > 1:
+                tasks = self._get_tasks(model_list, jobs, limit, sort, using, chunk_size,
+                            batch_size, use_natural_keys)
+                fragments = self._dump_parallel(tasks, jobs)
+                try:
+                    serializer = get_streaming_serializer(format)()
+                    serializer.serialize_python(self._merge_fragments(fragments), stream=out,
+                        indent=indent)
+                finally:
+                    for label, path in fragments:
+                        os.unlink(path)
+                return
+
+            if stream:
+                objects = self._iter_objects(model_list, limit, sort, using, chunk_size, batch_size,
+                                             filters, **walk)
+                serializer = get_streaming_serializer(format)()
+                serializer.serialize(objects, stream=out, indent=indent,
+                    use_natural_keys=use_natural_keys)
+                return
+
+            # Now collate the objects to be serialized.
+            objects = []
+            seen = set()
+            for model in model_list:
+                if not self._can_dump_model(model, using):
+                    continue
 
-            objects.extend(objects_from_queryset(queryset, using=using))
+                queryset = self._get_query_set(model, sort, using, filters)[:limit]
 
-        objects = sort_dependencies(objects)
+                objects.extend(objects_from_queryset(queryset, using=using, batch_size=batch_size,
+                                                     seen=seen, **walk))
 
-        try:
-            return serializers.serialize(format, objects, indent=indent,
+            if limited:
+                clear_missing_references(objects, seen)
+            objects = sort_dependencies(objects)
+
+            data = serializers.serialize(format, objects, indent=indent,
                         use_natural_keys=use_natural_keys)
+            if not output:
+                return data
+            out.write(data)
         except Exception, e:
             if show_traceback:
                 raise
             raise CommandError("Unable to serialize database: %s" % e)
+        finally:
+            if output:
+                out.close()
 
 
 def sort_dependencies(objects):
@@ -215,72 +757,178 @@ def sort_dependencies(objects):
 
     1. We graph dependencies unrelated to natural_key.
     2. We take a list of objects, and return a sorted list of objects.
+
+    Objects of self referential models are also ordered so that they come
+    after the objects they reference.
     """
-    from django.db.models import get_model
-    # Process the list of models, and get the list of dependencies
-    model_dependencies = []
-    models = set()
-    model_list = set()
     objs_by_model = defaultdict(list)
     for o in objects:
-        model = o.__class__
-        objs_by_model[model].append(o)
-        model_list.add(model)
-
-    for model in model_list:
-        models.add(model)
-        # Add any explicitly defined dependencies
-        if hasattr(model, 'natural_key'):
-            deps = getattr(model.natural_key, 'dependencies', [])
-            if deps:
-                deps = [get_model(*d.split('.')) for d in deps]
-        else:
-            deps = []
-
-        # Now add a dependency for any FK or M2M relation with
-        # a model that defines a natural key
-        for field in itertools.chain(model._meta.fields, model._meta.many_to_many):
-            if hasattr(field.rel, 'to') and field.rel.to != model:
-                deps.append(field.rel.to)
-        model_dependencies.append((model, deps))
-
-    model_dependencies.reverse()
-    # Now sort the models to ensure that dependencies are met. This
-    # is done by repeatedly iterating over the input list of models.
-    # If all the dependencies of a given model are in the final list,
-    # that model is promoted to the end of the final list. This process
-    # continues until the input list is empty, or we do a full iteration
-    # over the input models without promoting a model to the final list.
-    # If we do a full iteration without a promotion, that means there are
-    # circular dependencies in the list.
-    model_list = []
-    while model_dependencies:
-        skipped = []
-        changed = False
-        while model_dependencies:
-            model, deps = model_dependencies.pop()
-
-            # If all of the models in the dependency list are either already
-            # on the final model list, or not on the original serialization list,
-            # then we've found another model with all it's dependencies satisfied.
-            found = True
-            for candidate in ((d not in models or d in model_list) for d in deps):
-                if not candidate:
-                    found = False
-            if found:
-                model_list.append(model)
-                changed = True
-            else:
-                skipped.append((model, deps))
-        if not changed:
-            raise CommandError("Can't resolve dependencies for %s in serialized app list." %
-                ', '.join('%s.%s' % (model._meta.app_label, model._meta.object_name)
-                for model, deps in sorted(skipped, key=lambda obj: obj[0].__name__))
-            )
-        model_dependencies = skipped
+        objs_by_model[o.__class__].append(o)
 
     sorted_results = []
-    for model in model_list:
-        sorted_results.extend(objs_by_model[model])
+    for model in sort_models(objs_by_model.keys()):
+        objs = objs_by_model[model]
+        fields = [f.attname for f in get_self_references(model)]
+        if fields:
+            objs = sort_rows(objs, lambda o: o.pk, lambda o: [getattr(o, f) for f in fields])
+        sorted_results.extend(objs)
 
     return sorted_results
+
+
+def sort_rows(rows, get_pk, get_parents):
+    """
+    Orders ``rows`` of a single model so that every row comes after the rows
+    it references, in a single pass. Rows are otherwise kept in the order
+    given, and rows which reference each other are left in that order.
+
+    ``get_pk`` returns the primary key of a row, and ``get_parents`` the
+    primary keys it references.
+    """
+    by_pk = dict((get_pk(r), r) for r in rows)
+    visited = set()
+    results = []
+    for row in rows:
+        pk = get_pk(row)
+        if pk in visited:
+            continue
+        visited.add(pk)
+
+        # depth first, so that parents are added before their children
+        stack = [(row, iter(get_parents(row)))]
+        while stack:
+            current, parents = stack[-1]
+            for parent_pk in parents:
+                if parent_pk in by_pk and parent_pk not in visited:
+                    visited.add(parent_pk)
+                    parent = by_pk[parent_pk]
+                    stack.append((parent, iter(get_parents(parent))))
+                    break
+            else:
+                stack.pop()
+                results.append(current)
+
+    return results
+
+
+# The dependencies of each model, and the order of each list of models sorted,
+# are computed once per process
+_model_dependencies = {}
+_sorted_models = {}
+
+
+def get_dependencies(model):
+    """
+    Returns a tuple of two sets for ``model``: the models it must be loaded
+    after, and the models it references through ForeignKeys which may be null.
+    The latter can be deferred when models depend on each other.
+    """
+    try:
+        return _model_dependencies[model]
+    except KeyError:
+        pass
+
+    from django.db.models import get_model
+    # Add any explicitly defined dependencies
+    if hasattr(model, 'natural_key'):
+        required = set(get_model(*d.split('.')) for d in getattr(model.natural_key, 'dependencies', []))
+    else:
+        required = set()
+    deferrable = set()
+
+    # Now add a dependency for any FK or M2M relation with
+    # a model that defines a natural key
+    for field in itertools.chain(model._meta.fields, model._meta.many_to_many):
+        if hasattr(field.rel, 'to') and field.rel.to != model:
+            if isinstance(field, ForeignKey) and field.null:
+                deferrable.add(field.rel.to)
+            else:
+                required.add(field.rel.to)
+
+    result = _model_dependencies[model] = (required, deferrable - required)
+    return result
+
+
+def get_model_dependencies(model):
+    """
+    Returns the list of other models which ``model`` depends on, either through
+    its ForeignKeys and ManyToManyFields, or its natural key dependencies.
+    """
+    required, deferrable = get_dependencies(model)
+    return list(required | deferrable)
+
+
+def get_self_references(model):
+    """
+    Returns the ForeignKeys of ``model`` which reference its own primary key.
+    """
+    return [f for f in model._meta.fields if isinstance(f, ForeignKey) and f.rel.to == model
+            and f.rel.field_name == model._meta.pk.name]
+
+
+def is_self_referential(model):
+    """
+    Returns True if ``model`` has a ForeignKey to itself.
+    """
+    return any(f.rel.to == model for f in model._meta.fields if isinstance(f, ForeignKey))
+
+
+def sort_models(model_list):
+    """
+    Sort a list of models by their dependancy graph, such that every model
+    comes after the models it references. Models are otherwise kept in the
+    order given.
+
+    Models which depend on each other are ordered by ignoring their nullable
+    ForeignKeys first, and then (if they still can't be ordered) every
+    dependency of the first such model. Loading relies on constraint checks
+    being deferred to the end of the transaction for those references.
+    """
+    key = tuple(model_list)
+    try:
+        return list(_sorted_models[key])
+    except KeyError:
+        pass
+
+    models = []
+    index = {}
+    for model in model_list:
+        if model not in index:
+            index[model] = len(models)
+            models.append(model)
+
+    # Kahn's algorithm, taking the first model given whenever there's a choice
+    pending = {}
+    dependents = defaultdict(list)
+    ready = []
+    for model in models:
+        required, deferrable = get_dependencies(model)
+        pending[model] = set(d for d in required | deferrable if d in index)
+        for dep in pending[model]:
+            dependents[dep].append(model)
+        if not pending[model]:
+            heapq.heappush(ready, index[model])
+
+    result = []
+    while len(result) < len(models):
+        if not ready:
+            waiting = sorted((m for m in models if pending[m]), key=index.get)
+            for model in waiting:
+                pending[model] -= get_dependencies(model)[1]
+                if not pending[model]:
+                    heapq.heappush(ready, index[model])
+                    break
+            else:
+                pending[waiting[0]].clear()
+                heapq.heappush(ready, index[waiting[0]])
+
+        model = models[heapq.heappop(ready)]
+        result.append(model)
+        for dependent in dependents[model]:
+            if model in pending[dependent]:
+                pending[dependent].remove(model)
+                if not pending[dependent]:
+                    heapq.heappush(ready, index[dependent])
+
+    _sorted_models[key] = result
+    return list(result)
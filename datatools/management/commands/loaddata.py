@@ -5,6 +5,8 @@ from __future__ import with_statement
 import sys
 import os
 import gzip
+import hashlib
+import multiprocessing
 import traceback
 import zipfile
 from optparse import make_option
@@ -13,11 +15,21 @@ from django.conf import settings
 from django.core import serializers
 from django.core.management.base import BaseCommand
 from django.core.management.color import no_style
-from django.db import (connections, router, transaction, DEFAULT_DB_ALIAS,
-      IntegrityError, DatabaseError)
-from django.db.models import get_apps
+from django.core.serializers.base import DeserializationError
+from django.db import connections, router, transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_apps, get_model
+from django.utils.encoding import smart_unicode
 from django.utils.itercompat import product
 
+from datatools.compression import ZstdFile, has_zstd
+from datatools.loaders import get_loader
+from datatools.records import INDEXABLE_COMPRESSION, MappedFile, get_record_index, open_records, split_records
+from datatools.management.commands.dumpdata import get_model_dependencies, is_self_referential
+from datatools.serializers import deserialize_records, get_record_reader, get_streaming_deserializer
+from datatools.snapshots import (LoadedObjects, SnapshotCache, get_file_signature, get_schema_signature,
+    restore_snapshot, take_snapshot)
+from datatools.utils import close_connections
+
 try:
     import bz2
     has_bz2 = True
@@ -30,24 +42,76 @@ class SingleZipReader(zipfile.ZipFile):
         zipfile.ZipFile.__init__(self, *args, **kwargs)
         if settings.DEBUG:
             assert len(self.namelist()) == 1, "Zip-compressed fixtures must contain only one file."
+        self._member = None
+
+    def _get_member(self):
+        if self._member is None:
+            self._member = self.open(self.namelist()[0])
+        return self._member
 
-    def read(self):
-        return zipfile.ZipFile.read(self, self.namelist()[0])
+    def read(self, *args):
+        return self._get_member().read(*args)
+
+    def readline(self, *args):
+        return self._get_member().readline(*args)
 
 
 compression_types = {
-    None:   file,
+    None:   MappedFile,
     'gz':   gzip.GzipFile,
     'zip':  SingleZipReader
 }
 if has_bz2:
     compression_types['bz2'] = bz2.BZ2File
+if has_zstd:
+    compression_types['zst'] = ZstdFile
+
+
+class WorkerError(Exception):
+    """
+    Raised when loading fixtures fails in a worker process, with the traceback
+    of the original exception.
+    """
 
 
 def humanize(dirname):
     return dirname and "'%s'" % dirname or 'absolute path'
 
 
+# The names of the files in each fixture directory, along with the time the
+# directory was last modified. Directories are listed once per process instead
+# of trying to open every possible fixture file name in them.
+_fixture_index = {}
+
+
+def get_fixture_index(directory):
+    """
+    Returns the set of names of the files in ``directory``, which is cached
+    until the directory is modified.
+    """
+    directory = os.path.abspath(directory)
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        return frozenset()
+
+    cached = _fixture_index.get(directory)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    names = frozenset(name for name in os.listdir(directory)
+                      if os.path.isfile(os.path.join(directory, name)))
+    _fixture_index[directory] = (mtime, names)
+    return names
+
+
+def clear_fixture_index():
+    """
+    Forgets the contents of every fixture directory listed so far.
+    """
+    _fixture_index.clear()
+
+
 class Command(BaseCommand):
     help = 'Installs the named fixture(s) in the database.'
     args = "fixture [fixture ...]"
@@ -56,6 +120,24 @@ class Command(BaseCommand):
         make_option('--database', action='store', dest='database',
             default=DEFAULT_DB_ALIAS, help='Nominates a specific database to load '
                 'fixtures into. Defaults to the "default" database.'),
+        make_option('--bulk', action='store_true', dest='bulk', default=False,
+            help='Insert objects in batches using bulk_create. No signals are sent for bulk '
+                 'inserted objects.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help='Number of objects per model to insert at a time with --bulk or --engine=native. '
+                 'Defaults to 500.'),
+        make_option('--engine', dest='engine', default='orm', choices=['orm', 'native'],
+            help='Load objects through the ORM (the default), or with the database\'s own bulk '
+                 'loading (COPY on PostgreSQL, executemany on SQLite). Other databases fall back '
+                 'to --bulk. No signals are sent when loading natively.'),
+        make_option('-j', '--jobs', dest='jobs', type='int', default=1,
+            help='Number of worker processes to load fixture files with. Files which do not depend '
+                 'on each other are loaded concurrently, each in its own transaction. SQLite allows a '
+                 'single writer, so there files are loaded one at a time in a single transaction.'),
+        make_option('--cache', dest='cache', metavar='DIR', default=None,
+            help='Keep the rows loaded from the fixtures in DIR, and restore them directly the next '
+                 'time the same fixture files are loaded into the same schema. Defaults to the '
+                 'DATATOOLS_FIXTURE_CACHE setting. No signals are sent for restored rows.'),
     )
 
     def get_app_fixtures(self):
@@ -71,12 +153,14 @@ class Command(BaseCommand):
 
         return [os.path.join(os.path.dirname(path), 'fixtures') for path in app_module_paths]
 
-    def load_fixture(self, fixture_label, using, commit=True):
-        fixture_count = 0
-        loaded_object_count = 0
-        fixture_object_count = 0
-        models = set()
+    def find_fixtures(self, fixture_label, using):
+        """
+        Returns a list of ``(fixture_dir, fixture_name, files)`` for every directory
+        searched for ``fixture_label``, where ``files`` is a list of
+        ``(full_path, format, compression_format)`` for each matching fixture.
 
+        Returns None if the label names an unknown serialization format.
+        """
         parts = fixture_label.split('.')
 
         if len(parts) > 1 and parts[-1] in compression_types:
@@ -102,9 +186,6 @@ class Command(BaseCommand):
             self.stderr.write(
                 self.style.ERROR("Problem installing fixture '%s': %s is not a known serialization format.\n" %
                     (fixture_name, format)))
-            if commit:
-                transaction.rollback(using=using)
-                transaction.leave_transaction_management(using=using)
             return
 
         if os.path.isabs(fixture_name):
@@ -112,11 +193,15 @@ class Command(BaseCommand):
         else:
             fixture_dirs = self.get_app_fixtures() + list(settings.FIXTURE_DIRS) + ['']
 
+        results = []
         for fixture_dir in fixture_dirs:
             if self.verbosity >= 2:
                 self.stdout.write("Checking %s for fixtures...\n" % humanize(fixture_dir))
 
-            label_found = False
+            # every candidate is in the same directory (the label may have one
+            # of its own), so it's only looked up once
+            names = get_fixture_index(os.path.dirname(os.path.join(fixture_dir, fixture_name)))
+            files = []
             for combo in product([using, None], formats, compression_formats):
                 database, format, compression_format = combo
                 file_name = '.'.join(
@@ -130,64 +215,119 @@ class Command(BaseCommand):
                     self.stdout.write("Trying %s for %s fixture '%s'...\n" % \
                         (humanize(fixture_dir), file_name, fixture_name))
                 full_path = os.path.join(fixture_dir, file_name)
-                open_method = compression_types[compression_format]
-                try:
-                    fixture = open_method(full_path, 'r')
-                except IOError:
+                if os.path.basename(full_path) not in names:
                     if self.verbosity >= 2:
                         self.stdout.write("No %s fixture '%s' in %s.\n" % \
                             (format, fixture_name, humanize(fixture_dir)))
                     continue
-                try:
-                    if label_found:
-                        self.stderr.write(self.style.ERROR("Multiple fixtures named '%s' in %s. Aborting.\n" %
-                            (fixture_name, humanize(fixture_dir))))
-                        if commit:
-                            transaction.rollback(using=using)
-                            transaction.leave_transaction_management(using=using)
-                        return
+                files.append((full_path, format, compression_format))
+            results.append((fixture_dir, fixture_name, files))
+
+        return results
+
+    def load_file(self, full_path, format, compression_format, using, start=None, stop=None):
+        """
+        Loads every object in a single fixture file, returning a tuple of the
+        number of objects in the file, the number of objects loaded, and the set
+        of models which were loaded.
+
+        JSON Lines fixtures can be loaded from record ``start`` up to ``stop``,
+        in which case the records before ``start`` are skipped without being
+        read, using the fixture's record index.
+        """
+        objects_in_fixture = 0
+        loaded_objects_in_fixture = 0
+        models = set()
 
-                    fixture_count += 1
-                    objects_in_fixture = 0
-                    loaded_objects_in_fixture = 0
-                    if self.verbosity >= 2:
-                        self.stdout.write("Installing %s fixture '%s' from %s.\n" % \
-                            (format, fixture_name, humanize(fixture_dir)))
+        if start is not None or stop is not None:
+            fixture = open_records(full_path, compression_format, start or 0, stop)
+        else:
+            fixture = compression_types[compression_format](full_path, 'r')
+        try:
+            iter_records = get_record_reader(format)
+            if iter_records is not None:
+                objects = deserialize_records(self.expect_records(iter_records(fixture)), using=using)
+            else:
+                objects = get_streaming_deserializer(format)(fixture, using=using)
+
+            for obj in objects:
+                objects_in_fixture += 1
+                if router.allow_syncdb(using, obj.object.__class__):
+                    loaded_objects_in_fixture += 1
+                    models.add(obj.object.__class__)
+                    # saving consumes the many to many data of the object
+                    if self.loaded is not None:
+                        self.loaded.add(obj)
+                    self.loader.load(obj)
+                if iter_records is None:
+                    self.loader.expect(None)
+            self.loader.flush()
+        except:
+            self.loader.clear()
+            raise
+        finally:
+            fixture.close()
+
+        return objects_in_fixture, loaded_objects_in_fixture, models
+
+    def expect_records(self, records):
+        """
+        Tells the loader the model of each of ``records`` before it is passed
+        on to be deserialized.
+        """
+        for record in records:
+            label = isinstance(record, dict) and record.get('model')
+            model = None
+            if isinstance(label, basestring) and label.count('.') == 1:
+                model = get_model(*label.split('.'))
+            self.loader.expect(model)
+            yield record
+
+    def load_fixture(self, fixture_label, using, commit=True, fixtures=None):
+        fixture_count = 0
+        loaded_object_count = 0
+        fixture_object_count = 0
+        models = set()
 
-                    objects = serializers.deserialize(format, fixture, using=using)
-
-                    for obj in objects:
-                        objects_in_fixture += 1
-                        if router.allow_syncdb(using, obj.object.__class__):
-                            loaded_objects_in_fixture += 1
-                            models.add(obj.object.__class__)
-                            try:
-                                obj.save(using=using)
-                            except (DatabaseError, IntegrityError), e:
-                                msg = "Could not load %(app_label)s.%(object_name)s(pk=%(pk)s): %(error_msg)s" % {
-                                        'app_label': obj.object._meta.app_label,
-                                        'object_name': obj.object._meta.object_name,
-                                        'pk': obj.object.pk,
-                                        'error_msg': e
-                                    }
-                                raise e.__class__, e.__class__(msg), sys.exc_info()[2]
+        if fixtures is None:
+            fixtures = self.find_fixtures(fixture_label, using)
+        if fixtures is None:
+            if commit:
+                transaction.rollback(using=using)
+                transaction.leave_transaction_management(using=using)
+            return
+
+        for fixture_dir, fixture_name, files in fixtures:
+            if len(files) > 1:
+                self.stderr.write(self.style.ERROR("Multiple fixtures named '%s' in %s. Aborting.\n" %
+                    (fixture_name, humanize(fixture_dir))))
+                if commit:
+                    transaction.rollback(using=using)
+                    transaction.leave_transaction_management(using=using)
+                return
+
+            for full_path, format, compression_format in files:
+                fixture_count += 1
+                objects_in_fixture = 0
+                if self.verbosity >= 2:
+                    self.stdout.write("Installing %s fixture '%s' from %s.\n" % \
+                        (format, fixture_name, humanize(fixture_dir)))
+                try:
+                    objects_in_fixture, loaded_objects_in_fixture, fixture_models = \
+                        self.load_file(full_path, format, compression_format, using)
 
                     loaded_object_count += loaded_objects_in_fixture
                     fixture_object_count += objects_in_fixture
-                    label_found = True
+                    models |= fixture_models
 
                 except (SystemExit, KeyboardInterrupt):
                     raise
                 except Exception:
-                    if self.show_traceback:
-                        traceback.print_exc()
-                    else:
-                        self.stderr.write(
-                            self.style.ERROR("Problem installing fixture '%s': %s\n" %
-                                 (full_path, ''.join(traceback.format_exception(sys.exc_type,
-                                     sys.exc_value, sys.exc_traceback)))))
-                finally:
-                    fixture.close()
+                    if commit:
+                        transaction.rollback(using=using)
+                        transaction.leave_transaction_management(using=using)
+                    self.report_error(full_path)
+                    return
 
                 # If the fixture we loaded contains 0 objects, assume that an
                 # error was encountered during fixture loading.
@@ -207,14 +347,73 @@ class Command(BaseCommand):
             'models': models,
         }
 
-    def handle(self, *fixture_labels, **options):
+    def report_error(self, full_path):
+        if self.show_traceback:
+            traceback.print_exc()
+        else:
+            self.stderr.write(
+                self.style.ERROR("Problem installing fixture '%s': %s\n" %
+                     (full_path, ''.join(traceback.format_exception(sys.exc_type,
+                         sys.exc_value, sys.exc_traceback)))))
+
+    def setup(self, **options):
         self.verbosity = int(options.get('verbosity', 1))
         self.show_traceback = options.get('traceback', False)
+        self.style = no_style()
 
         using = options.get('database')
 
+        self.loader = get_loader(using, engine=options.get('engine') or 'orm', bulk=options.get('bulk'),
+                                 batch_size=options.get('batch_size') or 500)
+
+        # the cache is either True, to only keep snapshots in memory, or a directory
+        cache = options.get('cache') or getattr(settings, 'DATATOOLS_FIXTURE_CACHE', None)
+        if cache:
+            self.cache = SnapshotCache(cache is not True and cache or None)
+        else:
+            self.cache = None
+        self.loaded = None
+
+    def get_cache_key(self, fixtures, using):
+        """
+        Returns the key the rows loaded from ``fixtures`` are cached under, which
+        is a digest of the contents of every fixture file and of the schema.
+
+        Returns None if a fixture label could not be resolved to a single file
+        per directory, in which case loading reports the error as usual.
+        """
+        digest = hashlib.sha1(using)
+        digest.update(get_schema_signature(using))
+        for found in fixtures:
+            if found is None:
+                return None
+            for fixture_dir, fixture_name, files in found:
+                if len(files) > 1:
+                    return None
+                for full_path, format, compression_format in files:
+                    digest.update('%s %s %s\n' % (get_file_signature(full_path), format, compression_format))
+        return digest.hexdigest()
+
+    def restore_cached(self, snapshot, using):
+        """
+        Writes back the rows of a cached snapshot, returning the same counts as
+        ``load_fixture``.
+        """
+        if self.verbosity >= 2:
+            self.stdout.write("Restoring %d cached object(s)\n" % snapshot['loaded_object_count'])
+        restore_snapshot(using, snapshot['rows'])
+        return {
+            'fixture_count': snapshot['fixture_count'],
+            'loaded_object_count': snapshot['loaded_object_count'],
+            'fixture_object_count': snapshot['fixture_object_count'],
+            'models': set(get_model(*label) for label in snapshot['models']),
+        }
+
+    def handle(self, *fixture_labels, **options):
+        self.setup(**options)
+
+        using = options.get('database')
         connection = connections[using]
-        self.style = no_style()
 
         if not len(fixture_labels):
             self.stderr.write(
@@ -222,6 +421,9 @@ class Command(BaseCommand):
             )
             return
 
+        if options.get('jobs', 1) > 1:
+            return self.load_parallel(fixture_labels, using, **options)
+
         # commit is a stealth option - it isn't really useful as
         # a command line option, but it can be useful when invoking
         # loaddata from within another script.
@@ -245,15 +447,34 @@ class Command(BaseCommand):
         # single transaction to ensure that all references are resolved.
         if commit:
             transaction.commit_unless_managed(using=using)
+            self.loader.begin()
             transaction.enter_transaction_management(using=using)
             transaction.managed(True, using=using)
 
+        # Fixture labels are resolved up front when caching, as the cache is
+        # keyed on the files they resolve to
+        cache_key = snapshot = None
+        fixtures = [None] * len(fixture_labels)
+        if self.cache is not None:
+            fixtures = [self.find_fixtures(label, using) for label in fixture_labels]
+            cache_key = self.get_cache_key(fixtures, using)
+            if cache_key is not None:
+                snapshot = self.cache.get(cache_key)
+                self.loaded = LoadedObjects()
+
         try:
             with connection.constraint_checks_disabled():
-                for fixture_label in fixture_labels:
-                    result = self.load_fixture(fixture_label, using=using, commit=commit)
+                if snapshot is not None:
+                    results = [self.restore_cached(snapshot, using)]
+                else:
+                    results = (self.load_fixture(label, using=using, commit=commit, fixtures=found)
+                               for label, found in zip(fixture_labels, fixtures))
+
+                for result in results:
                     if not result:
-                        continue
+                        # The transaction has already been rolled back
+                        self.loader.close()
+                        return
 
                     fixture_count += result['fixture_count']
                     loaded_object_count += result['loaded_object_count']
@@ -265,28 +486,55 @@ class Command(BaseCommand):
             table_names = [model._meta.db_table for model in models]
             connection.check_constraints(table_names=table_names)
 
+            if cache_key is not None and snapshot is None:
+                rows = take_snapshot(using, self.loaded)
+                if rows is not None:
+                    self.cache.set(cache_key, {
+                        'rows': rows,
+                        'models': [(m._meta.app_label, m._meta.object_name) for m in models],
+                        'fixture_count': fixture_count,
+                        'loaded_object_count': loaded_object_count,
+                        'fixture_object_count': fixture_object_count,
+                    })
+
         except (SystemExit, KeyboardInterrupt):
             raise
         except Exception:
             if commit:
                 transaction.rollback(using=using)
                 transaction.leave_transaction_management(using=using)
+            self.loader.close()
             return
 
         # If we found even one object in a fixture, we need to reset the
         # database sequences.
         if loaded_object_count > 0:
-            sequence_sql = connection.ops.sequence_reset_sql(self.style, models)
-            if sequence_sql:
-                if self.verbosity >= 2:
-                    self.stdout.write("Resetting sequences\n")
-                for line in sequence_sql:
-                    cursor.execute(line)
+            self.reset_sequences(connection, models)
 
         if commit:
             transaction.commit(using=using)
             transaction.leave_transaction_management(using=using)
+        self.loader.close()
+
+        self.report_installed(loaded_object_count, fixture_object_count, fixture_count)
 
+        # Close the DB connection. This is required as a workaround for an
+        # edge case in MySQL: if the same connection is used to
+        # create tables, load data, and query, the query can return
+        # incorrect results. See Django #7572, MySQL #37735.
+        if commit:
+            connection.close()
+
+    def reset_sequences(self, connection, models):
+        sequence_sql = connection.ops.sequence_reset_sql(self.style, models)
+        if sequence_sql:
+            if self.verbosity >= 2:
+                self.stdout.write("Resetting sequences\n")
+            cursor = connection.cursor()
+            for line in sequence_sql:
+                cursor.execute(line)
+
+    def report_installed(self, loaded_object_count, fixture_object_count, fixture_count):
         if self.verbosity >= 1:
             if fixture_object_count == loaded_object_count:
                 self.stdout.write("Installed %d object(s) from %d fixture(s)\n" % (
@@ -295,9 +543,279 @@ class Command(BaseCommand):
                 self.stdout.write("Installed %d object(s) (of %d) from %d fixture(s)\n" % (
                     loaded_object_count, fixture_object_count, fixture_count))
 
-        # Close the DB connection. This is required as a workaround for an
-        # edge case in MySQL: if the same connection is used to
-        # create tables, load data, and query, the query can return
-        # incorrect results. See Django #7572, MySQL #37735.
-        if commit:
-            connection.close()
+    def get_fixture_models(self, full_path, format, compression_format, using):
+        """
+        Returns the set of models which have objects in a fixture file.
+
+        Only the model of each record is read where the format allows it, as
+        other fields (such as natural keys) may refer to objects which are only
+        loaded from other fixtures.
+        """
+        fixture = compression_types[compression_format](full_path, 'r')
+        try:
+            iter_records = get_record_reader(format)
+            if iter_records is None:
+                return set(o.object.__class__ for o in
+                           get_streaming_deserializer(format)(fixture, using=using))
+
+            models = set()
+            for label in set(record['model'] for record in iter_records(fixture)):
+                model = get_model(*label.split('.'))
+                if model is None:
+                    raise DeserializationError("Invalid model identifier: '%s'" % label)
+                models.add(model)
+            return models
+        finally:
+            fixture.close()
+
+    def split_fixture(self, fixture, models, parts):
+        """
+        Returns a list of ``(full_path, format, compression_format, start, stop)``
+        record ranges to load a fixture file in, which can be loaded concurrently.
+
+        Only JSON Lines fixtures of a single model which doesn't refer to itself
+        are split, as rows in one range can't refer to rows in another.
+        """
+        full_path, format, compression_format = fixture
+        if (parts < 2 or format != 'jsonl' or compression_format not in INDEXABLE_COMPRESSION
+                or len(models) != 1 or is_self_referential(list(models)[0])):
+            return [fixture + (None, None)]
+
+        ranges = split_records(len(get_record_index(full_path, compression_format)), parts)
+        if len(ranges) == 1:
+            return [fixture + (None, None)]
+        return [fixture + r for r in ranges]
+
+    def load_parallel(self, fixture_labels, using, **options):
+        """
+        Loads fixture files concurrently across ``jobs`` worker processes, each in
+        a transaction (and with a database connection) of its own.
+
+        Files are loaded in groups, so that the files containing the models which
+        other files depend on are committed first. Constraints are checked once
+        all files have been loaded. Unlike a regular load this is not atomic: if a
+        file fails to load, the files which were loaded before it stay in place.
+
+        SQLite only allows a single writer at a time, so workers would just wait
+        on each other's locks. There, files are loaded one after another in this
+        process instead, in a single transaction, in the same order.
+        """
+        connection = connections[using]
+        serial = connection.vendor == 'sqlite'
+
+        if not options.get('commit', True):
+            self.stderr.write(self.style.ERROR("Parallel loads manage their own transactions, "
+                                               "and cannot be used with commit=False.\n"))
+            return
+
+        files = []
+        for fixture_label in fixture_labels:
+            fixtures = self.find_fixtures(fixture_label, using)
+            if fixtures is None:
+                return
+            for fixture_dir, fixture_name, fixture_files in fixtures:
+                if len(fixture_files) > 1:
+                    self.stderr.write(self.style.ERROR("Multiple fixtures named '%s' in %s. Aborting.\n" %
+                        (fixture_name, humanize(fixture_dir))))
+                    return
+                files.extend(fixture_files)
+
+        fixture_models = []
+        for full_path, format, compression_format in files:
+            try:
+                fixture_models.append(self.get_fixture_models(full_path, format, compression_format, using))
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception:
+                self.report_error(full_path)
+                return
+
+        groups = []
+        for group in group_fixtures(fixture_models):
+            tasks = []
+            for task in group:
+                if len(task) == 1 and not serial:
+                    # large files are split into record ranges, loaded by separate workers
+                    tasks.extend([r] for r in self.split_fixture(files[task[0]], fixture_models[task[0]],
+                                                                 options['jobs']))
+                else:
+                    tasks.append([files[i] + (None, None) for i in task])
+            groups.append(tasks)
+
+        results = []
+        if not serial:
+            results = self.run_workers(groups, files, options)
+            if results is None:
+                return
+
+        transaction.commit_unless_managed(using=using)
+        if serial:
+            self.loader.begin()
+        transaction.enter_transaction_management(using=using)
+        transaction.managed(True, using=using)
+        try:
+            if serial:
+                with connection.constraint_checks_disabled():
+                    results = [load_task(self, task, using) for tasks in groups for task in tasks]
+
+            loaded_object_count = sum(r['loaded_object_count'] for r in results)
+            fixture_object_count = sum(r['fixture_object_count'] for r in results)
+            models = set(get_model(*label.split('.')) for r in results for label in r['models'])
+
+            connection.check_constraints(table_names=[model._meta.db_table for model in models])
+            if loaded_object_count > 0:
+                self.reset_sequences(connection, models)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception:
+            transaction.rollback(using=using)
+            transaction.leave_transaction_management(using=using)
+            if serial:
+                self.loader.close()
+            self.report_error(', '.join(f[0] for f in files))
+            return
+        transaction.commit(using=using)
+        transaction.leave_transaction_management(using=using)
+        if serial:
+            self.loader.close()
+
+        self.report_installed(loaded_object_count, fixture_object_count, len(files))
+
+        connection.close()
+
+    def run_workers(self, groups, files, options):
+        """
+        Runs the tasks of each group across ``jobs`` worker processes, one group
+        after another, returning the result of every task, or None if one of
+        them failed.
+        """
+        close_connections()
+
+        worker_options = dict((k, options.get(k)) for k in ('verbosity', 'traceback', 'database',
+                                                            'bulk', 'batch_size', 'engine'))
+
+        results = []
+        pool = multiprocessing.Pool(options['jobs'])
+        try:
+            for tasks in groups:
+                results.extend(pool.imap_unordered(load_shard, [(t, worker_options) for t in tasks]))
+            pool.close()
+        except (SystemExit, KeyboardInterrupt):
+            pool.terminate()
+            raise
+        except Exception:
+            self.report_error(', '.join(f[0] for f in files))
+            pool.terminate()
+            return None
+        finally:
+            pool.join()
+        return results
+
+
+def load_task(command, files, using):
+    """
+    Loads a list of fixture files (or record ranges of them) with ``command``,
+    returning the object counts and the labels of the models loaded.
+    """
+    result = {
+        'fixture_object_count': 0,
+        'loaded_object_count': 0,
+        'models': set(),
+    }
+    for full_path, format, compression_format, start, stop in files:
+        if command.verbosity >= 2:
+            if start is not None:
+                command.stdout.write("Installing records %d to %d of %s fixture from %s.\n" % (
+                    start, stop, format, full_path))
+            else:
+                command.stdout.write("Installing %s fixture from %s.\n" % (format, full_path))
+        objects_in_fixture, loaded_objects_in_fixture, models = \
+            command.load_file(full_path, format, compression_format, using, start, stop)
+        result['fixture_object_count'] += objects_in_fixture
+        result['loaded_object_count'] += loaded_objects_in_fixture
+        result['models'].update(smart_unicode(m._meta) for m in models)
+    return result
+
+
+def load_shard(args):
+    """
+    Loads a list of fixture files (or record ranges of them) in a single
+    transaction, returning the object counts and the labels of the models loaded.
+
+    This is run in worker processes when loading with ``--jobs``.
+    """
+    files, options = args
+    using = options['database']
+    connection = connections[using]
+
+    command = Command()
+    command.stdout, command.stderr = sys.stdout, sys.stderr
+    command.setup(**options)
+
+    command.loader.begin()
+    transaction.enter_transaction_management(using=using)
+    transaction.managed(True, using=using)
+    try:
+        with connection.constraint_checks_disabled():
+            result = load_task(command, files, using)
+        transaction.commit(using=using)
+    except Exception:
+        transaction.rollback(using=using)
+        # the exception is sent back to the parent process, and not every
+        # exception (or the exceptions it wraps) can be pickled
+        raise WorkerError(traceback.format_exc())
+    except:
+        transaction.rollback(using=using)
+        raise
+    finally:
+        transaction.leave_transaction_management(using=using)
+        command.loader.close()
+        connection.close()
+
+    return result
+
+
+def group_fixtures(fixture_models):
+    """
+    Given the set of models contained in each fixture, returns a list of groups
+    which can be loaded one after another, such that every fixture is loaded
+    after the fixtures containing the models it depends on.
+
+    Each group is a list of tasks, and each task a list of fixture indexes to be
+    loaded together. The tasks within a group are independent of each other.
+    """
+    dependencies = {}
+    for models in fixture_models:
+        for model in models:
+            if model not in dependencies:
+                dependencies[model] = set(get_model_dependencies(model))
+
+    # A fixture depends on every fixture containing models which its own models
+    # reference. Rows of self referential models may reference rows in another
+    # fixture of the same model, so those are loaded in the order given.
+    fixture_dependencies = []
+    for i, models in enumerate(fixture_models):
+        deps = set()
+        for j, other in enumerate(fixture_models):
+            if i == j:
+                continue
+            if any(dependencies[m] & other for m in models):
+                deps.add(j)
+            elif j < i and any(is_self_referential(m) for m in models & other):
+                deps.add(j)
+        fixture_dependencies.append(deps)
+
+    groups = []
+    remaining = set(xrange(len(fixture_models)))
+    loaded = set()
+    while remaining:
+        group = sorted(i for i in remaining if fixture_dependencies[i] <= loaded)
+        if not group:
+            # Fixtures which depend on each other are loaded in a single
+            # transaction, where constraints are only checked at the end
+            groups.append([sorted(remaining)])
+            break
+        groups.append([[i] for i in group])
+        loaded.update(group)
+        remaining.difference_update(group)
+    return groups
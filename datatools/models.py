@@ -5,3 +5,7 @@ datatools.models
 :copyright: (c) 2011 DISQUS.
 :license: Apache License 2.0, see LICENSE for more details.
 """
+
+from datatools.serializers import register_serializers
+
+register_serializers()
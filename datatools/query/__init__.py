@@ -6,4 +6,5 @@ datatools.query.range
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+from datatools.query.checkpoints import *
 from datatools.query.range import *
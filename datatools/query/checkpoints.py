@@ -0,0 +1,74 @@
+"""
+datatools.query.checkpoints
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import cPickle as pickle
+import os
+
+from datatools.utils import dump_atomic
+
+__all__ = ('FileCheckpointStore', 'CacheCheckpointStore')
+
+
+class FileCheckpointStore(object):
+    """
+    Persists ``RangeQuerySetWrapper`` checkpoints to a file.
+
+    >>> store = FileCheckpointStore('/var/tmp/backfill.checkpoint')
+    >>> for obj in RangeQuerySetWrapper(Model.objects.all(), checkpoint_store=store):
+    >>>     print obj
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        try:
+            fp = open(self.path, 'rb')
+        except IOError:
+            return None
+        try:
+            return pickle.load(fp)
+        finally:
+            fp.close()
+
+    def set(self, checkpoint):
+        dump_atomic(checkpoint, self.path)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class CacheCheckpointStore(object):
+    """
+    Persists ``RangeQuerySetWrapper`` checkpoints to ``key`` in one of Django's
+    cache backends.
+
+    Checkpoints are kept for ``timeout`` seconds (a week by default) rather than
+    the backend's default timeout, which is usually only five minutes: a job
+    restarted any later than that would otherwise silently start over.
+    """
+
+    # one week
+    default_timeout = 60 * 60 * 24 * 7
+
+    def __init__(self, key, backend='default', timeout=default_timeout):
+        from django.core.cache import get_cache
+
+        self.key = key
+        self.cache = get_cache(backend)
+        self.timeout = timeout
+
+    def get(self):
+        return self.cache.get(self.key)
+
+    def set(self, checkpoint):
+        self.cache.set(self.key, checkpoint, self.timeout)
+
+    def delete(self):
+        self.cache.delete(self.key)
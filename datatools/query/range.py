@@ -6,9 +6,19 @@ datatools.query.range
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
-from datatools.utils import attach_foreignkey
+import sys
+import threading
+import time
+from Queue import Queue, Full
 
-__all__ = ('RangeQuerySetWrapper', 'InvalidQuerySetError')
+from django.db import connections, transaction
+from django.db.models import Max, Min, Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet, ValuesQuerySet, ValuesListQuerySet
+
+from datatools.utils import attach_related, split_range
+
+__all__ = ('RangeQuerySetWrapper', 'PartitionedRangeQuerySetWrapper', 'InvalidQuerySetError')
 
 
 class InvalidQuerySetError(ValueError):
@@ -19,10 +29,49 @@ class RangeQuerySetWrapper(object):
     """
     Iterates through a queryset by chunking results by ``step`` and using GREATER THAN
     and LESS THAN queries on the primary key.
+
+    ``select_related`` takes a list of relation paths such as
+    ``thread__forum__category`` or ``forum__thread_set``, which are fetched
+    with one query per level per chunk (see ``datatools.utils.attach_related``).
+    Related objects shared with the previous chunk are not fetched again, or
+    pass a ``cache`` (such as ``datatools.utils.LRUCache``) to hold on to them
+    for longer, or to share them between iterations.
+
+    ``values()`` and ``values_list()`` querysets (or a list of ``fields``, which is
+    shorthand for ``values_list(*fields)``) yield rows without building model
+    instances, and the position of the cursor is read from the rows themselves.
+
+    Setting ``target_time`` (in seconds) makes the size of each chunk adaptive: after
+    every query ``step`` is scaled (by at most a factor of two) towards the number
+    of rows that can be fetched in that time, within ``min_step`` and ``max_step``
+    (which default to 1 and ten times the initial ``step``).
+
+    ``checkpoint`` holds the position of the cursor once every row of a chunk has
+    been consumed. It can be passed back as ``resume_from`` to pick up where a
+    previous iteration stopped. Given a ``checkpoint_store`` (see
+    ``datatools.query.checkpoints``) it is saved every ``checkpoint_every`` chunks,
+    iteration resumes from the stored checkpoint, and the checkpoint is removed
+    once iteration completes.
+
+    When ``prefetch`` is set, chunks are fetched in a background thread (with a
+    database connection of its own) so that up to ``prefetch`` chunks are
+    queried while the current one is being processed. Other connections can't see
+    rows which haven't been committed yet, so chunks are fetched in the calling
+    thread instead while a transaction is managed (``transaction.is_managed``).
     """
 
     def __init__(self, queryset, step=1000, limit=None, min_id=None, max_id=None, sorted=True,
-                 select_related=[], callbacks=[], order_by='pk'):
+                 select_related=[], callbacks=[], order_by='pk', prefetch=0, fields=None,
+                 target_time=None, min_step=None, max_step=None, resume_from=None,
+                 checkpoint_store=None, checkpoint_every=1, cache=None):
+        if fields is not None:
+            if isinstance(queryset, ValuesQuerySet):
+                raise InvalidQuerySetError
+            queryset = queryset.values_list(*fields)
+        # model instances are needed to attach related objects to
+        if select_related and isinstance(queryset, ValuesQuerySet):
+            raise InvalidQuerySetError
+
         # Support for slicing
         if queryset.query.low_mark == 0 and not\
           (queryset.query.order_by or queryset.query.extra_order_by):
@@ -45,9 +94,138 @@ class RangeQuerySetWrapper(object):
         self.sorted = sorted or not max_id
         self.select_related = select_related
         self.callbacks = callbacks
+        self.cache = cache
         self.order_by = order_by
+        self.prefetch = prefetch
+        self.target_time = target_time
+        self.min_step = min_step or 1
+        self.max_step = max_step or self.step * 10
+        if limit:
+            self.max_step = min(self.max_step, limit)
+        self.checkpoint_store = checkpoint_store
+        self.checkpoint_every = checkpoint_every
+        if resume_from is None and checkpoint_store is not None:
+            resume_from = checkpoint_store.get()
+        # where every iteration starts from, while ``checkpoint`` reports progress
+        self.resume_from = resume_from
+        self.checkpoint = resume_from
+
+    def _is_unique(self):
+        opts = self.queryset.model._meta
+        if self.order_by in ('pk', opts.pk.name, opts.pk.attname):
+            return True
+        try:
+            return opts.get_field(self.order_by).unique
+        except FieldDoesNotExist:
+            return False
+
+    def _get_accessors(self, queryset):
+        """
+        Returns the queryset to query, a function which returns the
+        ``(order_by, pk)`` values of a result, and a function which returns the
+        result as it should be yielded.
+
+        Rows of a ``values()`` or ``values_list()`` queryset which do not include
+        the columns we need to seek on have them added to the query, and
+        stripped again before they are yielded.
+        """
+        if not isinstance(queryset, ValuesQuerySet):
+            order_by = self.order_by
+            return queryset, lambda result: (getattr(result, order_by), result.pk), lambda result: result
+
+        opts = queryset.model._meta
+
+        def aliases(name):
+            if name in ('pk', opts.pk.name, opts.pk.attname):
+                return ('pk', opts.pk.name, opts.pk.attname)
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                return (name,)
+            return (name, field.name, field.attname)
+
+        names = list(queryset._fields) or [f.attname for f in opts.fields]
+        count = len(names)
+
+        def index(name):
+            for n, column in enumerate(names):
+                if column in aliases(name):
+                    return n
+            names.append(name)
+            return len(names) - 1
+
+        cursor_index, pk_index = index(self.order_by), index('pk')
+
+        if isinstance(queryset, ValuesListQuerySet):
+            flat = queryset.flat
+            if flat or len(names) > count:
+                queryset = queryset.values_list(*names)
+
+            def get_cursor(row):
+                return row[cursor_index], row[pk_index]
+
+            if flat:
+                get_row = lambda row: row[0]
+            elif len(names) > count:
+                get_row = lambda row: row[:count]
+            else:
+                get_row = lambda row: row
+        else:
+            if len(names) > count:
+                queryset = queryset.values(*names)
+            cursor_key, pk_key, added = names[cursor_index], names[pk_index], names[count:]
+
+            def get_cursor(row):
+                return row[cursor_key], row[pk_key]
+
+            def get_row(row):
+                for key in added:
+                    del row[key]
+                return row
+
+        return queryset, get_cursor, get_row
+
+    def _adjust_step(self, step, elapsed):
+        """
+        Scales ``step`` towards the number of rows which can be fetched in
+        ``target_time`` seconds, given that ``step`` rows took ``elapsed``.
+        """
+        if elapsed > 0:
+            factor = min(max(self.target_time / elapsed, 0.5), 2.0)
+        else:
+            factor = 2.0
+        return int(min(max(step * factor, self.min_step), self.max_step))
 
     def __iter__(self):
+        self.checkpoint = self.resume_from
+        chunks = self._iter_chunks()
+        if self.prefetch and not transaction.is_managed(using=self.queryset.db):
+            chunks = iter_threaded([chunks], self.prefetch, self.queryset.db)
+
+        store = self.checkpoint_store
+        for n, (chunk, checkpoint) in enumerate(chunks):
+            for result in chunk:
+                yield result
+            self.checkpoint = checkpoint
+            if store is not None and (n + 1) % self.checkpoint_every == 0:
+                store.set(checkpoint)
+
+        if store is not None:
+            store.delete()
+
+    def iter_chunks(self):
+        """
+        Yields the results a list at a time, one list per query, with
+        ``select_related`` and ``callbacks`` already applied.
+        """
+        for chunk, checkpoint in self._iter_chunks():
+            yield chunk
+
+    def _iter_chunks(self):
+        """
+        Yields each chunk of results along with the checkpoint to resume from
+        once it has been consumed.
+        """
         max_value = self.max_value
         if self.min_value is not None:
             cur_value = self.min_value
@@ -59,53 +237,73 @@ class RangeQuerySetWrapper(object):
         num = 0
         limit = self.limit
 
-        queryset = self.queryset
+        # rows which share a value in a column that is not unique are told apart
+        # by their primary key, so we seek on (order_by, pk) rather than order_by
+        unique = self._is_unique()
+        if unique:
+            ordering = [self.order_by]
+        else:
+            ordering = [self.order_by, 'pk']
+
+        queryset, get_cursor, get_row = self._get_accessors(self.queryset)
         if max_value:
             queryset = queryset.filter(**{'%s__lte' % self.order_by: max_value})
             # Adjust the sort order if we're stepping through reverse
         if self.sorted:
             if self.desc:
-                queryset = queryset.order_by('-%s' % self.order_by)
+                queryset = queryset.order_by(*['-%s' % f for f in ordering])
             else:
-                queryset = queryset.order_by(self.order_by)
+                queryset = queryset.order_by(*ordering)
 
-        # we implement basic cursor pagination for columns that are not unique
+        if self.desc:
+            inclusive, exclusive = 'lte', 'lt'
+        else:
+            inclusive, exclusive = 'gte', 'gt'
+        # stepping forwards there's nothing left once max_value is reached,
+        # while stepping back that is where we start from
+        past_max = max_value and not self.desc
+
+        # without a sort order we can only implement basic cursor pagination
         last_value = None
+        last_pk = None
         offset = 0
         has_results = True
-        while ((max_value and cur_value <= max_value) or has_results) and (not self.limit or num < self.limit):
+        step = self.step
+        if self.cache is not None:
+            related_cache = self.cache
+        else:
+            related_cache = RelatedCache()
+
+        if self.resume_from is not None:
+            cur_value, last_value, last_pk, offset, num, step = self.resume_from
+        # the queryset is already bounded by max_value, so an empty chunk means
+        # we've run out of rows (rather than just reaching a gap in the range)
+        while has_results and (not self.limit or num < self.limit):
             start = num
 
             if cur_value is None:
                 results = queryset
-            elif self.desc:
-                results = queryset.filter(**{'%s__lte' % self.order_by: cur_value})
-            elif not self.desc:
-                results = queryset.filter(**{'%s__gte' % self.order_by: cur_value})
-
-            results = results[offset:offset + self.step].iterator()
+            elif not self.sorted or last_pk is None:
+                results = queryset.filter(**{'%s__%s' % (self.order_by, inclusive): cur_value})
+            elif unique:
+                results = queryset.filter(**{'%s__%s' % (self.order_by, exclusive): cur_value})
+            else:
+                results = queryset.filter(
+                    Q(**{'%s__%s' % (self.order_by, exclusive): cur_value}) |
+                    Q(**{self.order_by: cur_value, 'pk__%s' % exclusive: last_pk}))
 
-            # hash maps to pull in select_related columns
-            if self.select_related:
-                # we have to pull them all into memory to do the select_related
-                results = list(results)
-                for fkey in self.select_related:
-                    if '__' in fkey:
-                        fkey, related = fkey.split('__')
-                    else:
-                        related = []
-                    attach_foreignkey(results, getattr(self.queryset.model, fkey, related))
-
-            if self.callbacks:
-                results = list(results)
-                for callback in self.callbacks:
-                    callback(results)
+            if self.sorted:
+                results = results[:step].iterator()
+            else:
+                results = results[offset:offset + step].iterator()
 
+            started = time.time()
+            chunk = []
             for result in results:
-                yield result
+                cur_value, last_pk = get_cursor(result)
+                chunk.append(get_row(result))
 
                 num += 1
-                cur_value = getattr(result, self.order_by)
                 if cur_value == last_value:
                     offset += 1
                 else:
@@ -114,10 +312,182 @@ class RangeQuerySetWrapper(object):
                     last_value = cur_value
                     offset = 1
 
-                if (max_value and cur_value >= max_value) or (limit and num >= limit):
+                if (past_max and cur_value >= max_value) or (limit and num >= limit):
                     break
 
-            if cur_value is None:
+            if not chunk:
+                break
+
+            if self.target_time:
+                step = self._adjust_step(step, time.time() - started)
+
+            # hash maps to pull in select_related columns
+            for path in self.select_related:
+                attach_related(chunk, path, cache=related_cache)
+            if self.cache is None:
+                related_cache.rotate()
+
+            for callback in self.callbacks:
+                callback(chunk)
+
+            yield chunk, (cur_value, last_value, last_pk, offset, num, step)
+
+            if cur_value is None or (unique and past_max and cur_value >= max_value):
                 break
 
             has_results = num > start
+
+
+class RelatedCache(object):
+    """
+    Holds the related objects attached to the current and the previous chunk,
+    so that parents shared by neighbouring chunks are only fetched once.
+    """
+
+    def __init__(self):
+        self.previous, self.current = {}, {}
+
+    def get(self, key):
+        obj = self.current.get(key)
+        if obj is None:
+            obj = self.previous.get(key)
+            if obj is not None:
+                self.current[key] = obj
+        return obj
+
+    def __setitem__(self, key, obj):
+        self.current[key] = obj
+
+    def rotate(self):
+        self.previous, self.current = self.current, {}
+
+
+class PartitionedRangeQuerySetWrapper(object):
+    """
+    Splits the primary key range of a queryset into ``partitions`` ranges, and
+    iterates through each of them at the same time using ``RangeQuerySetWrapper``.
+
+    Every partition is walked in a thread of its own, and so with a database
+    connection of its own. Callbacks are run in those threads for each chunk,
+    and results are yielded as they arrive, in no particular order.
+
+    Other connections can't see rows which haven't been committed yet, so
+    while a transaction is managed the partitions are walked one after the
+    other in the calling thread instead.
+
+    >>> for obj in PartitionedRangeQuerySetWrapper(Model.objects.all(), partitions=8):
+    >>>     print obj
+    """
+
+    def __init__(self, queryset, partitions=4, step=1000, min_id=None, max_id=None,
+                 select_related=[], callbacks=[], fields=None):
+        if queryset.query.low_mark or queryset.query.high_mark is not None or\
+          queryset.query.order_by or queryset.query.extra_order_by:
+            raise InvalidQuerySetError
+
+        self.queryset = queryset
+        self.partitions = partitions
+        self.step = abs(step)
+        self.min_value, self.max_value = min_id, max_id
+        self.select_related = select_related
+        self.callbacks = callbacks
+        self.fields = fields
+
+    def get_partitions(self):
+        """
+        Returns a ``RangeQuerySetWrapper`` for each range of primary keys.
+        """
+        min_value, max_value = self.min_value, self.max_value
+        if min_value is None or max_value is None:
+            queryset = self.queryset
+            if isinstance(queryset, ValuesQuerySet):
+                # values() masks out aggregates, and its columns would otherwise
+                # end up in the aggregate query
+                queryset = queryset._clone(klass=QuerySet)
+                queryset.query.clear_select_fields()
+                queryset.query.set_aggregate_mask(None)
+            bounds = queryset.aggregate(min_id=Min('pk'), max_id=Max('pk'))
+            if min_value is None:
+                min_value = bounds['min_id']
+            if max_value is None:
+                max_value = bounds['max_id']
+        if min_value is None or max_value is None:
+            return []
+
+        return [RangeQuerySetWrapper(self.queryset.all(), step=self.step, min_id=lower, max_id=upper,
+                                     select_related=self.select_related, callbacks=self.callbacks,
+                                     fields=self.fields)
+                for lower, upper in split_range(min_value, max_value, self.partitions)]
+
+    def __iter__(self):
+        partitions = self.get_partitions()
+        if not partitions:
+            return
+
+        if transaction.is_managed(using=self.queryset.db):
+            chunks = (chunk for p in partitions for chunk in p.iter_chunks())
+        else:
+            chunks = iter_threaded([p.iter_chunks() for p in partitions], len(partitions) * 2,
+                                   self.queryset.db)
+        for chunk in chunks:
+            for result in chunk:
+                yield result
+
+
+def iter_threaded(iterables, size, using):
+    """
+    Consumes each of ``iterables`` in a thread of its own, and yields their
+    items as they become available. At most ``size`` items are buffered
+    ahead of the caller, and any exception raised by an iterable is re-raised
+    in the calling thread.
+
+    Items from a single iterable are yielded in order. Each thread closes its
+    connection to ``using`` once it is done.
+    """
+    queue = Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def consume(iterable):
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception:
+            put((None, sys.exc_info()))
+        else:
+            put((None, None))
+        finally:
+            connections[using].close()
+
+    threads = []
+    for iterable in iterables:
+        thread = threading.Thread(target=consume, args=(iterable,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        running = len(threads)
+        while running:
+            item, exc_info = queue.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is None:
+                running -= 1
+                continue
+            yield item
+    finally:
+        # workers give up as soon as they see this, which is at most an
+        # item away, so waiting for them is cheap
+        stop.set()
+        for thread in threads:
+            thread.join()
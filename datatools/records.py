@@ -0,0 +1,316 @@
+"""
+datatools.records
+~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import bisect
+import cPickle as pickle
+import gzip
+import mmap
+import os
+import zlib
+from array import array
+
+from datatools.utils import dump_atomic
+
+__all__ = ('MappedFile', 'RecordIndex', 'get_record_index', 'open_records', 'split_records',
+           'INDEXABLE_COMPRESSION')
+
+# Compression formats which records can be indexed in
+INDEXABLE_COMPRESSION = (None, 'gz')
+
+
+class MappedFile(object):
+    """
+    Reads a file through ``mmap``, optionally only the bytes between ``start``
+    and ``stop``. Empty files, which can't be mapped, read as empty.
+    """
+
+    def __init__(self, path, mode='r', start=0, stop=None):
+        fp = open(path, 'rb')
+        try:
+            size = os.fstat(fp.fileno()).st_size
+            if size:
+                self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.map = None
+        finally:
+            # the map keeps a descriptor of its own
+            fp.close()
+        self.pos = start
+        self.end = size
+        if stop is not None:
+            self.end = min(stop, size)
+
+    def read(self, size=-1):
+        if self.map is None or self.pos >= self.end:
+            return ''
+        if size < 0 or self.pos + size > self.end:
+            size = self.end - self.pos
+        data = self.map[self.pos:self.pos + size]
+        self.pos += size
+        return data
+
+    def readline(self, size=-1):
+        if self.map is None or self.pos >= self.end:
+            return ''
+        end = self.map.find('\n', self.pos, self.end)
+        end = end == -1 and self.end or end + 1
+        if size >= 0:
+            end = min(end, self.pos + size)
+        data = self.map[self.pos:end]
+        self.pos = end
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class _RangeReader(object):
+    """
+    Reads at most ``size`` bytes from ``fileobj``, closing ``files`` once done.
+    """
+
+    def __init__(self, fileobj, size, files):
+        self.fileobj = fileobj
+        self.remaining = size
+        self.files = files
+
+    def read(self, size=-1):
+        if self.remaining is not None:
+            if size < 0 or size > self.remaining:
+                size = self.remaining
+            self.remaining -= size
+        return self.fileobj.read(size)
+
+    def readline(self, size=-1):
+        if self.remaining is not None:
+            if size < 0 or size > self.remaining:
+                size = self.remaining
+            if not size:
+                return ''
+        line = self.fileobj.readline(size)
+        if self.remaining is not None:
+            self.remaining -= len(line)
+        return line
+
+    def close(self):
+        for fp in self.files:
+            fp.close()
+
+
+class _LineScanner(object):
+    """
+    Collects the offsets at which each non-blank line of the data fed to it
+    starts, matching the records read by the jsonl deserializer.
+    """
+
+    def __init__(self):
+        self.offsets = array('L')
+        self.size = 0
+        self.line_start = 0
+        self.blank = True
+
+    def feed(self, data):
+        start = 0
+        while True:
+            end = data.find('\n', start)
+            if self.blank and data[start:end == -1 and len(data) or end].strip():
+                self.blank = False
+            if end == -1:
+                break
+            if not self.blank:
+                self.offsets.append(self.line_start)
+            self.line_start = self.size + end + 1
+            self.blank = True
+            start = end + 1
+        self.size += len(data)
+
+    def close(self):
+        if not self.blank:
+            self.offsets.append(self.line_start)
+        self.blank = True
+
+
+class RecordIndex(object):
+    """
+    The byte offsets at which each record (line) of a JSON Lines fixture starts,
+    so that records can be read from any point without parsing what's before.
+
+    Gzip files also keep the compressed and uncompressed offsets at which each
+    gzip member starts. Files written by dumpdata are made of many members, so
+    reading can start at the member containing a record, rather than having to
+    decompress the file from the start.
+    """
+
+    def __init__(self, offsets, size, members=None, stat=None):
+        self.offsets = offsets
+        # the uncompressed size of the file
+        self.size = size
+        self.members = members
+        # the size and modification time of the file which was indexed
+        self.stat = stat
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def build(cls, path, compression=None, chunk_size=1024 * 1024):
+        if compression not in INDEXABLE_COMPRESSION:
+            raise ValueError("Records can't be indexed in %s compressed files" % compression)
+
+        stat = os.stat(path)
+        scanner = _LineScanner()
+        members = None
+
+        fp = open(path, 'rb')
+        try:
+            if compression is None:
+                for data in iter(lambda: fp.read(chunk_size), ''):
+                    scanner.feed(data)
+            else:
+                members = []
+                decompressor = None
+                pos = 0
+                data = fp.read(chunk_size)
+                while data:
+                    if decompressor is None:
+                        members.append((pos, scanner.size))
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    scanner.feed(decompressor.decompress(data))
+                    if decompressor.unused_data:
+                        # the member ended, and another one starts in this chunk
+                        pos += len(data) - len(decompressor.unused_data)
+                        data = decompressor.unused_data
+                        decompressor = None
+                    else:
+                        pos += len(data)
+                        data = fp.read(chunk_size)
+        finally:
+            fp.close()
+        scanner.close()
+
+        return cls(scanner.offsets, scanner.size, members, (stat.st_size, stat.st_mtime))
+
+    def is_current(self, path):
+        """
+        Returns True if the file at ``path`` hasn't changed since it was indexed.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return self.stat == (stat.st_size, stat.st_mtime)
+
+    def get_offset(self, record):
+        """
+        Returns the uncompressed offset at which ``record`` starts, or the size
+        of the file for records past the end.
+        """
+        if record >= len(self.offsets):
+            return self.size
+        return self.offsets[record]
+
+    def get_member(self, offset):
+        """
+        Returns the ``(compressed, uncompressed)`` offsets of the gzip member
+        containing the uncompressed ``offset``.
+        """
+        if not self.members:
+            return (0, 0)
+        index = bisect.bisect_right([m[1] for m in self.members], offset) - 1
+        return self.members[max(index, 0)]
+
+
+def get_record_index(path, compression=None):
+    """
+    Returns the ``RecordIndex`` of a fixture, which is cached in a file next to
+    it (named after the fixture, with an ``.idx`` suffix) until the fixture is
+    modified.
+    """
+    index_path = path + '.idx'
+    try:
+        fp = open(index_path, 'rb')
+    except IOError:
+        pass
+    else:
+        try:
+            index = pickle.load(fp)
+        except Exception:
+            index = None
+        finally:
+            fp.close()
+        if index is not None and index.is_current(path):
+            return index
+
+    index = RecordIndex.build(path, compression)
+
+    try:
+        dump_atomic(index, index_path)
+    except EnvironmentError:
+        # fixtures in read-only directories are indexed every time
+        pass
+    return index
+
+
+def open_records(path, compression=None, start=0, stop=None, index=None):
+    """
+    Returns a file-like object which reads the records of a JSON Lines fixture
+    from ``start`` up to (but not including) ``stop``, seeking straight to the
+    first of them with the fixture's record index.
+
+    >>> fixture = open_records('forums.jsonl', start=10000, stop=20000)
+    >>> objects = get_streaming_deserializer('jsonl')(fixture)
+    """
+    if index is None:
+        index = get_record_index(path, compression)
+    begin = index.get_offset(start)
+    end = None
+    if stop is not None:
+        end = index.get_offset(stop)
+
+    if compression is None:
+        return MappedFile(path, 'r', begin, end)
+
+    compressed, uncompressed = index.get_member(begin)
+    fp = open(path, 'rb')
+    try:
+        fp.seek(compressed)
+        fixture = gzip.GzipFile(fileobj=fp, mode='rb')
+        # skip to the record within its member
+        skip = begin - uncompressed
+        while skip > 0:
+            data = fixture.read(min(skip, 1024 * 1024))
+            if not data:
+                break
+            skip -= len(data)
+    except:
+        fp.close()
+        raise
+    if end is not None:
+        end = max(end - begin, 0)
+    return _RangeReader(fixture, end, [fixture, fp])
+
+
+def split_records(count, parts, min_records=1000):
+    """
+    Splits ``count`` records into at most ``parts`` ``(start, stop)`` ranges of
+    at least ``min_records`` records each.
+    """
+    parts = max(min(parts, count // min_records), 1)
+    size, extra = divmod(count, parts)
+    ranges = []
+    start = 0
+    for n in xrange(parts):
+        stop = start + size + (n < extra and 1 or 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
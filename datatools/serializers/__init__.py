@@ -0,0 +1,82 @@
+"""
+datatools.serializers
+~~~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from django.core import serializers
+from django.core.serializers.base import DeserializationError
+from django.core.serializers.python import Deserializer as PythonDeserializer
+from django.utils import importlib
+
+# Formats provided by datatools, in addition to Django's own
+BUILTIN_SERIALIZERS = {
+    'jsonl': 'datatools.serializers.jsonl',
+}
+
+# Serializers which write each object to the stream as soon as it has been
+# serialized, and deserializers which read one object at a time, rather than
+# buffering the entire document in memory.
+STREAMING_SERIALIZERS = {
+    'json': 'datatools.serializers.json',
+    'jsonl': 'datatools.serializers.jsonl',
+}
+
+
+def register_serializers():
+    """
+    Registers the formats provided by datatools with Django, unless a format of
+    the same name has already been configured through SERIALIZATION_MODULES.
+    """
+    formats = serializers.get_serializer_formats()
+    for format, module in BUILTIN_SERIALIZERS.iteritems():
+        if format not in formats:
+            serializers.register_serializer(format, module)
+
+
+def get_streaming_serializer(format):
+    """
+    Returns a serializer class for ``format`` which writes objects out as it
+    goes, falling back to Django's serializer when no streaming version exists.
+    """
+    if format in STREAMING_SERIALIZERS:
+        return importlib.import_module(STREAMING_SERIALIZERS[format]).Serializer
+    return serializers.get_serializer(format)
+
+
+def get_record_reader(format):
+    """
+    Returns a function which yields the raw (Python) records read from a stream
+    of ``format``, without resolving their fields against the database, or None
+    if there is no streaming version of the format.
+    """
+    if format in STREAMING_SERIALIZERS:
+        return importlib.import_module(STREAMING_SERIALIZERS[format]).iter_records
+    return None
+
+
+def deserialize_records(records, **options):
+    """
+    Deserializes raw (Python) records, such as those read by ``get_record_reader``,
+    one at a time, mapping any error to ``DeserializationError``.
+    """
+    try:
+        for obj in PythonDeserializer(records, **options):
+            yield obj
+    except GeneratorExit:
+        raise
+    except Exception, e:
+        # Map to deserializer error
+        raise DeserializationError(e)
+
+
+def get_streaming_deserializer(format):
+    """
+    Returns a deserializer for ``format`` which reads objects in one at a time,
+    falling back to Django's deserializer when no streaming version exists.
+    """
+    if format in STREAMING_SERIALIZERS:
+        return importlib.import_module(STREAMING_SERIALIZERS[format]).Deserializer
+    return serializers.get_deserializer(format)
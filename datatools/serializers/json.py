@@ -0,0 +1,151 @@
+"""
+datatools.serializers.json
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from StringIO import StringIO
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.serializers.python import Serializer as PythonSerializer
+from django.utils import simplejson
+
+from datatools.serializers import deserialize_records
+
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',]'
+
+
+class Serializer(PythonSerializer):
+    """
+    Convert a queryset to JSON, writing each object to the stream as soon as it
+    has been serialized instead of building the entire list in memory.
+    """
+    internal_use_only = False
+
+    def start_serialization(self):
+        super(Serializer, self).start_serialization()
+        self.configure()
+        if self.options.get('indent'):
+            self.separator = ',\n'
+        else:
+            self.separator = ', '
+        self.first = True
+        self.stream.write('[')
+
+    def configure(self):
+        if simplejson.__version__.split('.') >= ['2', '1', '3']:
+            # Use JS strings to represent Python Decimal instances (ticket #16850)
+            self.options.update({'use_decimal': False})
+
+    def end_serialization(self):
+        self.stream.write(']')
+
+    def end_object(self, obj):
+        super(Serializer, self).end_object(obj)
+        self.write_object(self.objects.pop())
+
+    def serialize_python(self, objects, **options):
+        """
+        Writes an iterable of objects which have already been serialized by the
+        ``python`` serializer.
+        """
+        self.options = options
+        self.stream = options.pop('stream', StringIO())
+        self.start_serialization()
+        for data in objects:
+            self.write_object(data)
+        self.end_serialization()
+        return self.getvalue()
+
+    def write_object(self, data):
+        """
+        Writes a single serialized (Python) object to the stream.
+        """
+        if not self.first:
+            self.stream.write(self.separator)
+        self.first = False
+        self.stream.write(self.dumps(data))
+
+    def dumps(self, data):
+        return simplejson.dumps(data, cls=DjangoJSONEncoder, **self.options)
+
+    def getvalue(self):
+        if callable(getattr(self.stream, 'getvalue', None)):
+            return self.stream.getvalue()
+
+
+def Deserializer(stream_or_string, **options):
+    """
+    Deserialize a stream or string of JSON data, one object at a time.
+    """
+    if isinstance(stream_or_string, basestring):
+        stream = StringIO(stream_or_string)
+    else:
+        stream = stream_or_string
+    return deserialize_records(iter_array(stream), **options)
+
+
+def iter_records(stream):
+    """
+    Yields the raw (Python) records of a fixture without resolving them.
+    """
+    return iter_array(stream)
+
+
+def iter_array(stream, buffer_size=64 * 1024):
+    """
+    Yields each element of the JSON array read from ``stream``, decoding them one
+    at a time so that only a single element is held in memory.
+    """
+    decoder = simplejson.JSONDecoder()
+    buf, pos, eof = '', 0, False
+
+    def fill(buf, pos):
+        # Drop everything that has already been consumed, and read at least
+        # as much again as what's left to avoid re-parsing large elements
+        data = stream.read(max(buffer_size, len(buf) - pos))
+        return buf[pos:] + data, 0, not data
+
+    def skip(buf, pos, eof):
+        while True:
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf, pos, eof
+            buf, pos, eof = fill(buf, pos)
+
+    buf, pos, eof = skip(buf, pos, eof)
+    if buf[pos:pos + 1] != '[':
+        raise ValueError("Expected a JSON array")
+    pos += 1
+
+    first = True
+    while True:
+        buf, pos, eof = skip(buf, pos, eof)
+        if pos == len(buf):
+            raise ValueError("Unterminated JSON array")
+        if buf[pos] == ']':
+            return
+        if not first:
+            if buf[pos] != ',':
+                raise ValueError("Expected ',' or ']' at position %d" % pos)
+            buf, pos, eof = skip(buf, pos + 1, eof)
+        first = False
+
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # Make sure the element wasn't cut short by the end of the buffer
+                if eof or (end < len(buf) and buf[end] in DELIMITERS):
+                    pos = end
+                    break
+            buf, pos, eof = fill(buf, pos)
+
+        yield obj
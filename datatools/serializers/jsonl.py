@@ -0,0 +1,63 @@
+"""
+datatools.serializers.jsonl
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+from StringIO import StringIO
+
+from django.core.serializers.python import Serializer as PythonSerializer
+from django.utils import simplejson
+
+from datatools.serializers import deserialize_records
+from datatools.serializers.json import Serializer as JSONSerializer
+
+
+class Serializer(JSONSerializer):
+    """
+    Convert a queryset to JSON Lines, writing each object on a line of its own
+    as soon as it has been serialized.
+    """
+
+    def start_serialization(self):
+        PythonSerializer.start_serialization(self)
+        # Every object has to be written out on a single line
+        self.options.pop('indent', None)
+        self.configure()
+
+    def end_serialization(self):
+        pass
+
+    def write_object(self, data):
+        self.stream.write(self.dumps(data))
+        self.stream.write('\n')
+
+
+def Deserializer(stream_or_string, **options):
+    """
+    Deserialize a stream or string of JSON Lines data, one line at a time.
+    """
+    if isinstance(stream_or_string, basestring):
+        stream = StringIO(stream_or_string)
+    else:
+        stream = stream_or_string
+    return deserialize_records(iter_lines(stream), **options)
+
+
+def iter_records(stream):
+    """
+    Yields the raw (Python) records of a fixture without resolving them.
+    """
+    return iter_lines(stream)
+
+
+def iter_lines(stream):
+    """
+    Yields the object on each (non-blank) line of ``stream``.
+    """
+    for line in iter(stream.readline, ''):
+        line = line.strip()
+        if line:
+            yield simplejson.loads(line)
@@ -0,0 +1,205 @@
+"""
+datatools.snapshots
+~~~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2011-2012 DISQUS.
+:license: Apache License 2.0, see LICENSE for more details.
+"""
+
+import cPickle as pickle
+import hashlib
+import os
+from collections import defaultdict
+
+from django.db import connections, router
+from django.db.models import get_models
+
+from datatools.utils import LRUCache, chunked, dump_atomic
+
+__all__ = ('LoadedObjects', 'SnapshotCache', 'take_snapshot', 'restore_snapshot', 'get_schema_signature',
+           'get_file_signature')
+
+# Digests of fixture files, keyed on their path, size and modification time
+_file_signatures = {}
+
+
+class LoadedObjects(object):
+    """
+    Keeps track of the primary keys, and the many to many relations, of the
+    objects loaded from fixtures so their rows can be snapshotted afterwards.
+
+    Objects loaded without a primary key are given whichever one the database
+    picks, and restoring them under that key would overwrite the row which
+    has it by then, so fixtures with any such object can't be snapshotted.
+    """
+
+    def __init__(self):
+        self.pks = defaultdict(set)
+        self.m2m = defaultdict(set)
+        self.cacheable = True
+
+    def add(self, obj):
+        model = obj.object._meta.concrete_model
+        if obj.object.pk is None:
+            self.cacheable = False
+            return
+        self.pks[model].add(obj.object.pk)
+        if obj.m2m_data:
+            self.m2m[model].update(obj.m2m_data)
+
+    def get_pks(self):
+        """
+        Returns a dictionary of primary keys by model, or None if some object
+        was loaded without a primary key.
+        """
+        if not self.cacheable:
+            return None
+        return self.pks.copy()
+
+
+def take_snapshot(using, loaded, batch_size=500):
+    """
+    Reads the rows of every object in ``loaded``, along with their many to many
+    relations, returning a list of ``(table, key_column, keys, columns, rows)``
+    which ``restore_snapshot`` writes back. Returns None if some object was
+    loaded without a primary key.
+    """
+    pks = loaded.get_pks()
+    if pks is None:
+        return None
+
+    connection = connections[using]
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+
+    def select(table, key_column, keys, columns):
+        rows = []
+        for chunk in chunked(sorted(keys), batch_size):
+            cursor.execute('SELECT %s FROM %s WHERE %s IN (%s)' % (
+                ', '.join(qn(c) for c in columns), qn(table), qn(key_column), ', '.join(['%s'] * len(chunk))),
+                chunk)
+            rows.extend(tuple(row) for row in cursor.fetchall())
+        return rows
+
+    snapshot = []
+    for model, keys in pks.iteritems():
+        opts = model._meta
+        columns = [f.column for f in opts.local_fields]
+        snapshot.append((opts.db_table, opts.pk.column, sorted(keys), columns,
+                         select(opts.db_table, opts.pk.column, keys, columns)))
+
+        for name in sorted(loaded.m2m.get(model, ())):
+            field = opts.get_field(name)
+            if not field.rel.through._meta.auto_created:
+                continue
+            columns = [field.m2m_column_name(), field.m2m_reverse_name()]
+            table = field.m2m_db_table()
+            snapshot.append((table, columns[0], sorted(keys), columns, select(table, columns[0], keys, columns)))
+
+    return snapshot
+
+
+def restore_snapshot(using, snapshot, batch_size=500):
+    """
+    Replaces the rows taken by ``take_snapshot``, deleting any rows with the
+    same keys first. Constraints are not checked and no signals are sent.
+    """
+    connection = connections[using]
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+
+    for table, key_column, keys, columns, rows in snapshot:
+        for chunk in chunked(keys, batch_size):
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                qn(table), qn(key_column), ', '.join(['%s'] * len(chunk))), chunk)
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            qn(table), ', '.join(qn(c) for c in columns), ', '.join(['%s'] * len(columns)))
+        for chunk in chunked(rows, batch_size):
+            cursor.executemany(sql, chunk)
+
+
+def get_schema_signature(using):
+    """
+    Returns a digest of the tables and columns of every model which is synced
+    to the ``using`` database, so snapshots are not reused across schemas.
+    """
+    connection = connections[using]
+    digest = hashlib.sha1(connection.vendor)
+    for model in sorted(get_models(include_auto_created=True), key=lambda m: m._meta.db_table):
+        if not router.allow_syncdb(using, model) or model._meta.proxy:
+            continue
+        digest.update(model._meta.db_table)
+        for field in model._meta.local_fields:
+            digest.update('%s %s' % (field.column, field.db_type(connection=connection)))
+    return digest.hexdigest()
+
+
+def get_file_signature(path):
+    """
+    Returns a digest of the contents of the file at ``path``. Digests are kept
+    until the file's size or modification time changes.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _file_signatures:
+        digest = hashlib.sha1()
+        fp = open(path, 'rb')
+        try:
+            for block in iter(lambda: fp.read(65536), ''):
+                digest.update(block)
+        finally:
+            fp.close()
+        _file_signatures[key] = digest.hexdigest()
+    return _file_signatures[key]
+
+
+class SnapshotCache(object):
+    """
+    Keeps snapshots in memory for the life of the process, and optionally as
+    files in ``path`` so they can be reused by later processes.
+
+    >>> cache = SnapshotCache('/var/tmp/fixtures')
+    >>> cache.set(key, take_snapshot(using, loaded))
+    >>> restore_snapshot(using, cache.get(key))
+    """
+
+    memory = LRUCache(size=100)
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def get_filename(self, key):
+        return os.path.join(self.path, '%s.snapshot' % key)
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or not self.path:
+            return value
+
+        try:
+            fp = open(self.get_filename(key), 'rb')
+        except IOError:
+            return None
+        try:
+            value = pickle.load(fp)
+        finally:
+            fp.close()
+        self.memory[key] = value
+        return value
+
+    def set(self, key, value):
+        self.memory[key] = value
+        if not self.path:
+            return
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        try:
+            dump_atomic(value, self.get_filename(key))
+        except (pickle.PicklingError, TypeError):
+            # some column values (such as buffers) can't be pickled, so the
+            # snapshot is only kept in memory
+            pass
+
+    def clear(self):
+        self.memory.clear()
@@ -6,8 +6,15 @@ datatools.utils
 :license: Apache License 2.0, see LICENSE for more details.
 """
 
+import cPickle as pickle
+import itertools
+import math
+import os
+import tempfile
+import time
 from collections import defaultdict
-from django.db.models.fields.related import SingleRelatedObjectDescriptor
+from django.db import connections
+from django.db.models.fields.related import SingleRelatedObjectDescriptor, ForeignRelatedObjectsDescriptor
 
 
 def distinct(l):
@@ -17,6 +24,165 @@ def distinct(l):
     return list(set(l))
 
 
+def chunked(iterable, size):
+    """
+    Given an iterable will yield lists of at most ``size`` items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def split_range(min_value, max_value, parts):
+    """
+    Splits the inclusive range ``[min_value, max_value]`` into at most ``parts``
+    contiguous, non-overlapping inclusive ranges.
+    """
+    size = max(1, int(math.ceil((max_value - min_value + 1) / float(parts))))
+    ranges = []
+    start = min_value
+    while start <= max_value:
+        end = min(start + size - 1, max_value)
+        ranges.append((start, end))
+        start = end + 1
+    return ranges
+
+
+def dump_atomic(value, path):
+    """
+    Pickles ``value`` to ``path``.
+
+    The value is written to a temporary file next to ``path`` first, which is
+    then renamed over it, so a crash never leaves a partially written file. If
+    ``value`` can't be pickled the temporary file is removed and the error is
+    raised.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    fp = os.fdopen(fd, 'wb')
+    try:
+        try:
+            pickle.dump(value, fp, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fp.close()
+    except:
+        os.unlink(tmp_path)
+        raise
+    os.rename(tmp_path, path)
+
+
+def close_connections():
+    """
+    Closes every open database connection before forking worker processes.
+
+    Each worker needs a connection of its own, and forking with open
+    connections would share their sockets with the children.
+    """
+    for connection in connections.all():
+        connection.close()
+
+
+def is_in_memory(connection):
+    """
+    Returns True if ``connection`` is to an in-memory SQLite database, which
+    other processes (and connections) can't see.
+    """
+    return connection.vendor == 'sqlite' and connection.settings_dict['NAME'] in ('', ':memory:')
+
+
+class LRUCache(object):
+    """
+    A mapping which holds at most ``size`` items, evicting the least recently
+    used first. If ``ttl`` is set, items older than ``ttl`` seconds are treated
+    as missing.
+
+    Lookups through ``get`` are counted in ``hits`` and ``misses``.
+
+    >>> cache = LRUCache(size=10000, ttl=300)
+    >>> attach_foreignkey(posts, Post.thread, cache=cache)
+    """
+
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        # a circular doubly linked list of [prev, next, key, value, expires],
+        # from the least to the most recently used
+        self.root = root = []
+        root[:] = [root, root, None, None, None]
+        self.links = {}
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        link = self.links.get(key)
+        return link is not None and not self._expired(link)
+
+    def _expired(self, link):
+        return link[4] is not None and link[4] < time.time()
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        last = self.root[0]
+        link[0], link[1] = last, self.root
+        last[1] = self.root[0] = link
+
+    def get(self, key, default=None):
+        link = self.links.get(key)
+        if link is not None and self._expired(link):
+            self._unlink(link)
+            del self.links[key]
+            link = None
+
+        if link is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def __setitem__(self, key, value):
+        link = self.links.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+
+        if self.ttl:
+            expires = time.time() + self.ttl
+        else:
+            expires = None
+        link = [None, None, key, value, expires]
+        self._append(link)
+        self.links[key] = link
+
+        while len(self.links) > self.size:
+            oldest = self.root[1]
+            self._unlink(oldest)
+            del self.links[oldest[2]]
+
+    def stats(self):
+        """
+        Returns the number of hits, misses and items held.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.links),
+        }
+
+
 def queryset_to_dict(qs, key='pk', singular=True):
     """
     Given a queryset will transform it into a dictionary based on ``key``.
@@ -32,13 +198,17 @@ def queryset_to_dict(qs, key='pk', singular=True):
     return result
 
 
-def attach_foreignkey(objects, field, related=[], database=None):
+def attach_foreignkey(objects, field, related=[], database=None, cache=None):
     """
     Shortcut method which handles a pythonic LEFT OUTER JOIN.
 
     ``attach_foreignkey(posts, Post.thread)``
 
     Works with both ForeignKey and OneToOne (reverse) lookups.
+
+    ``cache`` may be any mapping (with ``get``), such as an ``LRUCache``, keyed by
+    ``(model, database, pk)``. It is checked before querying for a ForeignKey,
+    and updated with what was fetched.
     """
 
     if not objects:
@@ -72,6 +242,15 @@ def attach_foreignkey(objects, field, related=[], database=None):
     # Ensure values are unique, do not contain already present values, and are not missing
     # values specified in select_related
     values = distinct(filter(None, (getattr(o, column) for o in objects)))
+    queryset = {}
+    # only objects looked up by their primary key can be shared
+    if cache is not None and not is_foreignkey:
+        for value in values:
+            obj = cache.get((model, database, value))
+            if obj is not None:
+                queryset[value] = obj
+        values = [v for v in values if v not in queryset]
+
     if values:
         qs = model.objects.filter(**{'%s__in' % lookup: values})
         if database:
@@ -79,9 +258,83 @@ def attach_foreignkey(objects, field, related=[], database=None):
         if related:
             qs = qs.select_related(*related)
 
-        queryset = queryset_to_dict(qs, key=key)
-    else:
-        queryset = {}
+        fetched = queryset_to_dict(qs, key=key)
+        if cache is not None and not is_foreignkey:
+            for value, obj in fetched.iteritems():
+                cache[(model, database, value)] = obj
+        queryset.update(fetched)
 
     for o in objects:
         setattr(o, accessor, queryset.get(getattr(o, column)))
+
+
+def attach_foreignkey_set(objects, descriptor, database=None):
+    """
+    Fetches the reverse side of a ForeignKey for all of ``objects`` in a single
+    query, so that ``manager.all()`` no longer needs to hit the database.
+
+    ``attach_foreignkey_set(threads, Thread.post_set)``
+
+    Returns the list of related objects.
+    """
+    if not objects:
+        return []
+
+    if database is None:
+        database = objects[0]._state.db
+
+    related = descriptor.related
+    field = related.field
+    attname = field.rel.get_related_field().attname
+    cache_name = field.related_query_name()
+
+    values = distinct(getattr(o, attname) for o in objects)
+    qs = related.model._default_manager.filter(**{'%s__%s__in' % (field.name, attname): values})
+    if database:
+        qs = qs.using(database)
+    results = list(qs)
+    queryset = queryset_to_dict(results, key=field.attname, singular=False)
+
+    for o in objects:
+        children = queryset.get(getattr(o, attname), [])
+        for child in children:
+            setattr(child, field.get_cache_name(), o)
+
+        qs = descriptor.__get__(o).all()
+        qs._result_cache = children
+        qs._prefetch_done = True
+        if not hasattr(o, '_prefetched_objects_cache'):
+            o._prefetched_objects_cache = {}
+        o._prefetched_objects_cache[cache_name] = qs
+
+    return results
+
+
+def attach_related(objects, path, database=None, cache=None):
+    """
+    Follows ``path`` (relation names separated by ``__``, as with ``select_related``)
+    from each of ``objects``, using a single query per level.
+
+    ``attach_related(posts, 'thread__forum__category')``
+
+    Works with ForeignKey and OneToOne relations in either direction as well
+    as the reverse side of a ForeignKey (``forum__thread_set``). ``cache`` is
+    passed on to ``attach_foreignkey``.
+    """
+    for name in path.split('__'):
+        if not objects:
+            return
+
+        descriptor = getattr(objects[0].__class__, name)
+        if isinstance(descriptor, ForeignRelatedObjectsDescriptor):
+            objects = attach_foreignkey_set(objects, descriptor, database=database)
+            continue
+
+        attach_foreignkey(objects, descriptor, database=database, cache=cache)
+        # the same object may be related to many others, but only needs visiting once
+        related = {}
+        for o in objects:
+            obj = getattr(o, descriptor.cache_name, None)
+            if obj is not None:
+                related[id(obj)] = obj
+        objects = related.values()
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
+import os
 import sys
+import tempfile
 from os.path import dirname, abspath, splitext
 from os import listdir
 from optparse import OptionParser
@@ -27,10 +29,18 @@ if not settings.configured:
                 'ENGINE': 'django.db.backends.sqlite3',
                 'TEST_NAME': ':memory:',
             },
+            # for tests which need more than one connection to the same
+            # database, such as threaded and parallel queries or loads
+            'file': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': 'datatools_file',
+                'TEST_NAME': os.path.join(tempfile.gettempdir(), 'datatools_tests.sqlite'),
+            },
         },
         INSTALLED_APPS=[
             'django.contrib.contenttypes',
             'django.contrib.auth',
+            'datatools',
         ],
         ROOT_URLCONF='',
         DEBUG=False,
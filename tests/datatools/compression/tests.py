@@ -0,0 +1,74 @@
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.test import TestCase
+from datatools.compression import CompressedWriter, get_output_compression, gzip_member
+from datatools.records import RecordIndex
+
+
+class FailingFile(StringIO):
+    def write(self, data):
+        raise IOError('disk full')
+
+
+class CompressedWriterTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.data = ''.join('%d\n' % n for n in xrange(10000))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, compression, **kwargs):
+        path = os.path.join(self.path, name)
+        out = CompressedWriter(open(path, 'wb'), compression, **kwargs)
+        for line in self.data.splitlines(True):
+            out.write(line)
+        out.close()
+        return path
+
+    def test_gzip(self):
+        path = self.write('data.gz', 'gz', block_size=1000, threads=3)
+        self.assertEquals(gzip.open(path).read(), self.data)
+        # every block is a gzip member of its own
+        self.assertTrue(open(path, 'rb').read().count('\x1f\x8b\x08') > len(self.data) / 1000)
+
+    def test_large_write(self):
+        path = os.path.join(self.path, 'data.gz')
+        out = CompressedWriter(open(path, 'wb'), 'gz', block_size=1000, threads=2)
+        out.write(self.data)
+        out.close()
+        self.assertEquals(gzip.open(path).read(), self.data)
+        # a member per block, rather than one for the whole write
+        self.assertEquals(len(RecordIndex.build(path, 'gz').members), -(-len(self.data) // 1000))
+
+    def test_bz2(self):
+        path = self.write('data.bz2', 'bz2', block_size=1000)
+        self.assertEquals(bz2.BZ2File(path).read(), self.data)
+
+    def test_empty(self):
+        path = os.path.join(self.path, 'empty.gz')
+        CompressedWriter(open(path, 'wb'), 'gz').close()
+        self.assertEquals(gzip.open(path).read(), '')
+
+    def test_error(self):
+        out = CompressedWriter(FailingFile(), 'gz', block_size=1)
+        self.assertRaises(IOError, lambda: [out.write('data') for n in xrange(100)])
+        out.close()
+
+        out = CompressedWriter(FailingFile(), 'bz2')
+        out.write('data')
+        self.assertRaises(IOError, out.close)
+
+    def test_output_compression(self):
+        self.assertEquals(get_output_compression('dump.json.gz'), 'gz')
+        self.assertEquals(get_output_compression('dump.json.zst'), 'zst')
+        self.assertEquals(get_output_compression('dump.json.zip'), 'zip')
+        self.assertEquals(get_output_compression('dump.json'), None)
+
+    def test_gzip_member(self):
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(gzip_member('a') + gzip_member('b', 9))).read(), 'ab')
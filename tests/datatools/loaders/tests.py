@@ -0,0 +1,23 @@
+import datetime
+from decimal import Decimal
+
+from django.test import TestCase
+from datatools.loaders import BulkLoader, Loader, SQLiteLoader, copy_value, get_loader
+
+
+class GetLoaderTest(TestCase):
+    def test_engines(self):
+        self.assertEquals(type(get_loader('default')), Loader)
+        self.assertEquals(type(get_loader('default', bulk=True)), BulkLoader)
+        self.assertEquals(type(get_loader('default', engine='native')), SQLiteLoader)
+        self.assertRaises(ValueError, get_loader, 'default', engine='foo')
+
+
+class CopyValueTest(TestCase):
+    def test_values(self):
+        self.assertEquals(copy_value(None), '\\N')
+        self.assertEquals(copy_value(True), 't')
+        self.assertEquals(copy_value(0), '0')
+        self.assertEquals(copy_value(Decimal('1.50')), '1.50')
+        self.assertEquals(copy_value(datetime.datetime(2012, 1, 2, 3, 4, 5)), '2012-01-02T03:04:05')
+        self.assertEquals(copy_value(u'caf\xe9\ta\\b\nc\r'), 'caf\xc3\xa9\\ta\\\\b\\nc\\r')
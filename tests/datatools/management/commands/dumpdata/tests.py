@@ -0,0 +1,317 @@
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, models
+from django.core.management.color import no_style
+from django.test import TestCase
+from django.utils import simplejson
+from datatools.management.commands.dumpdata import (Command, clear_missing_references, collect_objects,
+    dump_shard, objects_from_queryset, sort_dependencies, sort_models, sort_rows)
+from datatools.management.commands.loaddata import compression_types
+from datatools.serializers.json import Serializer
+
+
+class Author(models.Model):
+    favorite_book = models.ForeignKey('Book', null=True, related_name='+')
+
+    class Meta:
+        app_label = 'datatools_tests'
+
+
+class Book(models.Model):
+    author = models.ForeignKey(Author)
+
+    class Meta:
+        app_label = 'datatools_tests'
+
+
+class Publisher(models.Model):
+    book = models.ForeignKey(Book)
+
+    class Meta:
+        app_label = 'datatools_tests'
+
+
+class Editor(models.Model):
+    reviewer = models.ForeignKey('Reviewer')
+
+    class Meta:
+        app_label = 'datatools_tests'
+
+
+class Reviewer(models.Model):
+    editor = models.ForeignKey(Editor)
+
+    class Meta:
+        app_label = 'datatools_tests'
+
+
+class Category(models.Model):
+    parent = models.ForeignKey('self', null=True)
+
+    class Meta:
+        app_label = 'datatools_tests'
+
+
+class SortModelsTest(TestCase):
+    def test_dependencies_first(self):
+        self.assertEquals(sort_models([User, Group, Permission, ContentType]), [ContentType, Permission, Group, User])
+        self.assertEquals(sort_models([ContentType, User]), [ContentType, User])
+
+    def test_nullable_cycle(self):
+        # the nullable ForeignKey is deferred
+        self.assertEquals(sort_models([Publisher, Book, Author]), [Author, Book, Publisher])
+
+    def test_cycle(self):
+        self.assertEquals(sort_models([Reviewer, Editor, User]), [User, Reviewer, Editor])
+
+
+class SortRowsTest(TestCase):
+    def test_parents_first(self):
+        parents = {1: [3], 2: [1], 3: [None], 4: [5], 5: [], 6: [7]}
+        self.assertEquals(sort_rows([1, 2, 3, 4, 5, 6], lambda r: r, lambda r: parents[r]), [3, 1, 2, 5, 4, 6])
+
+    def test_cycle(self):
+        parents = {1: [2], 2: [1], 3: [2]}
+        self.assertEquals(sort_rows([1, 2, 3], lambda r: r, lambda r: parents[r]), [2, 1, 3])
+
+    def test_sort_dependencies(self):
+        categories = [Category(pk=1, parent_id=3), Category(pk=2, parent_id=None), Category(pk=3, parent_id=2)]
+        self.assertEquals([c.pk for c in sort_dependencies(categories)], [2, 3, 1])
+
+
+class DumpDataTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='staff')
+        self.group.permissions.add(Permission.objects.get(codename='add_user'))
+        for n in xrange(3):
+            user = User.objects.create(username=n, email='%s@example.com' % n)
+            user.groups.add(self.group)
+
+    def dumpdata(self, *args, **options):
+        stdout = StringIO()
+        call_command('dumpdata', stdout=stdout, *args, **options)
+        return simplejson.loads(stdout.getvalue())
+
+    def assertDependenciesFirst(self, data):
+        seen = set()
+        for obj in data:
+            if obj['model'] == 'auth.user':
+                for pk in obj['fields']['groups']:
+                    self.assertTrue(('auth.group', pk) in seen)
+            elif obj['model'] == 'auth.group':
+                for pk in obj['fields']['permissions']:
+                    self.assertTrue(('auth.permission', pk) in seen)
+            seen.add((obj['model'], obj['pk']))
+
+    def test_follows_dependencies(self):
+        data = self.dumpdata('auth.user')
+        models = set(o['model'] for o in data)
+        self.assertEquals(models, set(['auth.user', 'auth.group', 'auth.permission', 'contenttypes.contenttype']))
+        self.assertEquals(len([o for o in data if o['model'] == 'auth.user']), 3)
+        self.assertDependenciesFirst(data)
+
+    def test_objects_from_queryset_is_distinct(self):
+        objects = objects_from_queryset(User.objects.order_by('pk'))
+        keys = [(o.__class__, o.pk) for o in objects]
+        self.assertEquals(len(keys), len(set(keys)))
+        self.assertEquals(keys[:3], [(User, pk) for pk in User.objects.order_by('pk').values_list('pk', flat=True)])
+        self.assertEquals(keys, [(o.__class__, o.pk) for o in objects_from_queryset(User.objects.order_by('pk'))])
+
+    def test_collect_objects_skips_seen(self):
+        users = list(User.objects.all())
+        seen = set()
+        objects = collect_objects(users + users, seen=seen)
+        self.assertEquals(seen, set((o.__class__, o.pk) for o in objects))
+        self.assertEquals(collect_objects(users, seen=seen), [])
+
+    def test_collect_objects_batches_m2m(self):
+        for n in xrange(3, 10):
+            User.objects.create(username=n, email='%s@example.com' % n).groups.add(self.group)
+        users = list(User.objects.all())
+        # groups, user_permissions, group permissions and permission content types
+        with self.assertNumQueries(4):
+            objects = collect_objects(users)
+        self.assertTrue(self.group in objects)
+        self.assertTrue(Permission.objects.get(codename='add_user') in objects)
+
+    def test_collect_objects_chunks_in_queries(self):
+        permissions = list(Permission.objects.all())
+        content_types = set(p.content_type_id for p in permissions)
+        with self.assertNumQueries(len(content_types)):
+            objects = collect_objects(permissions, batch_size=1)
+        self.assertEquals(len(objects), len(permissions) + len(content_types))
+
+        seen = set((ContentType, pk) for pk in content_types)
+        with self.assertNumQueries(0):
+            collect_objects(permissions, seen=seen)
+
+    def test_stream(self):
+        expected = self.dumpdata('auth.user')
+        data = self.dumpdata('auth.user', stream=True, chunk_size=1)
+        self.assertEquals(sorted(data), sorted(expected))
+        self.assertDependenciesFirst(data)
+
+    def test_stream_keeps_dependency_keys_only(self):
+        seen = set()
+        objects = list(Command()._iter_objects([User, Group], chunk_size=1, seen=seen))
+        self.assertEquals(len(objects), len(set((o.__class__, o.pk) for o in objects)))
+        self.assertEquals(len([o for o in objects if isinstance(o, User)]), 3)
+        # groups were dumped in full, and users are told apart by how far the walk got
+        permission = Permission.objects.get(codename='add_user')
+        self.assertEquals(seen, set([(Permission, permission.pk), (ContentType, permission.content_type_id)]))
+
+    def test_stream_limit_and_sort(self):
+        data = self.dumpdata('auth.user', stream=True, chunk_size=1, limit=2, sort='desc')
+        users = [o['pk'] for o in data if o['model'] == 'auth.user']
+        self.assertEquals(users, sorted(User.objects.values_list('pk', flat=True), reverse=True)[:2])
+
+    def test_sharded_dump(self):
+        command = Command()
+        tasks = command._get_tasks([User, Group], 2, chunk_size=1)
+        self.assertEquals([t['model'] for t in tasks], ['auth.group', 'auth.user', 'auth.user'])
+        user_ids = sorted(User.objects.values_list('pk', flat=True))
+        self.assertEquals(tasks[1]['range'][0], user_ids[0])
+        self.assertEquals(tasks[2]['range'][1], user_ids[-1])
+
+        fragments = [f for task in tasks for f in dump_shard(task)]
+        stream = StringIO()
+        try:
+            Serializer().serialize_python(command._merge_fragments(fragments), stream=stream)
+        finally:
+            for label, path in fragments:
+                os.unlink(path)
+        data = simplejson.loads(stream.getvalue())
+        self.assertEquals(sorted(data), sorted(self.dumpdata('auth.user', 'auth.group')))
+        self.assertDependenciesFirst(data)
+
+    def test_compressed_output(self):
+        path = tempfile.mkdtemp()
+        try:
+            expected = self.dumpdata('auth.user')
+            for name in ('users.json.gz', 'users.json.bz2'):
+                call_command('dumpdata', 'auth.user', output=os.path.join(path, name))
+                fp = compression_types[name.rsplit('.', 1)[-1]](os.path.join(path, name), 'r')
+                self.assertEquals(sorted(simplejson.loads(fp.read())), sorted(expected))
+                fp.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_unwritable_compression(self):
+        path = tempfile.mkdtemp()
+        try:
+            output = os.path.join(path, 'users.json.zip')
+            self.assertRaises(CommandError, Command().handle, 'auth.user', output=output)
+            self.assertFalse(os.path.exists(output))
+        finally:
+            shutil.rmtree(path)
+
+    def test_subgraph(self):
+        def dumped(**options):
+            data = self.dumpdata(filters=['auth.User:username=0'], **options)
+            return sorted((obj['model'], obj['pk']) for obj in data)
+
+        user = User.objects.get(username='0')
+        permission = Permission.objects.get(codename='add_user')
+        self.assertEquals(dumped(), sorted([('auth.user', user.pk), ('auth.group', self.group.pk),
+            ('auth.permission', permission.pk), ('contenttypes.contenttype', permission.content_type_id)]))
+        self.assertEquals(dumped(max_depth=1), [('auth.group', self.group.pk), ('auth.user', user.pk)])
+        self.assertEquals(dumped(max_rows=1), [('auth.user', user.pk)])
+        self.assertEquals(dumped(exclude_edges=['auth.user.groups']), [('auth.user', user.pk)])
+        self.assertEquals(dumped(include_edges=['auth.user.user_permissions']), [('auth.user', user.pk)])
+        self.assertEquals(len(dumped(stream=True, max_rows=3)), 3)
+        self.assertEquals(dumped(exclude_edges=['auth.User.groups']), [('auth.user', user.pk)])
+        self.assertEquals(dumped(include_edges=['auth.User.user_permissions']), [('auth.user', user.pk)])
+
+    def test_stream_max_rows(self):
+        for n in xrange(3, 30):
+            User.objects.create(username=n, email='%s@example.com' % n)
+        # stops after the first chunk of users and their dependencies, rather
+        # than going on to read (and discard) the other chunks
+        with self.assertNumQueries(7):
+            data = self.dumpdata('auth.user', stream=True, chunk_size=10, max_rows=3, include_edges=[
+                'auth.user.user_permissions'])
+        self.assertEquals(len(data), 3)
+
+    def test_invalid_edge(self):
+        self.assertRaises(CommandError, Command().handle, 'auth.user', exclude_edges=['auth.User'])
+        self.assertRaises(CommandError, Command().handle, 'auth.user', exclude_edges=['auth.Foo.groups'])
+        self.assertRaises(CommandError, Command().handle, 'auth.user', include_edges=['auth.User.foo'])
+
+    def test_clears_missing_references(self):
+        permission = Permission.objects.get(codename='add_user')
+        collected = set()
+        objects = collect_objects([permission], seen=collected, max_depth=0)
+        self.assertEquals(objects, [permission])
+        clear_missing_references(objects, collected)
+        # not nullable, so left alone
+        self.assertNotEquals(permission.content_type_id, None)
+
+        categories = [Category(pk=1, parent_id=2), Category(pk=2, parent_id=1), Category(pk=3, parent_id=3)]
+        clear_missing_references(categories, set([(Category, 1), (Category, 3)]))
+        self.assertEquals([c.parent_id for c in categories], [None, 1, 3])
+
+    def test_invalid_filter(self):
+        self.assertRaises(CommandError, Command().handle, filters=['auth.User'])
+        self.assertRaises(CommandError, Command().handle, filters=['auth.Foo:id=1'])
+
+    def test_jobs_requires_database_file(self):
+        self.assertRaises(CommandError, Command().handle, 'auth.user', jobs=2)
+
+
+class StreamSelfReferenceTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Category isn't part of an installed app, so its table is made by hand
+        sql, references = connection.creation.sql_create_model(Category, no_style())
+        cursor = connection.cursor()
+        for statement in sql:
+            cursor.execute(statement)
+
+    @classmethod
+    def tearDownClass(cls):
+        connection.cursor().execute('DROP TABLE %s' % connection.ops.quote_name(Category._meta.db_table))
+
+    def setUp(self):
+        for n in xrange(1, 11):
+            Category.objects.create(pk=n, parent_id=n < 10 and n + 1 or None)
+
+    def parents(self, **options):
+        return dict((c.pk, c.parent_id) for c in Command()._iter_objects([Category], chunk_size=3, **options))
+
+    def test_keeps_references_to_later_chunks(self):
+        expected = dict((n, n < 10 and n + 1 or None) for n in xrange(1, 11))
+        self.assertEquals(self.parents(max_depth=0), expected)
+        self.assertEquals(self.parents(max_depth=0, sort='desc'), expected)
+
+    def test_clears_references_to_rows_left_out(self):
+        expected = {1: 2, 2: 3, 3: 4, 4: 5, 5: None}
+        self.assertEquals(self.parents(max_depth=0, filters={Category: {'pk__lte': 5}}), expected)
+        self.assertEquals(self.parents(max_depth=0, limit=5), expected)
+        self.assertEquals(self.parents(max_depth=0, limit=5, sort='desc'),
+                          {10: None, 9: 10, 8: 9, 7: 8, 6: 7})
+
+    def test_dependencies_ahead(self):
+        seen = set()
+        categories = list(Command()._iter_objects([Category], chunk_size=3, seen=seen))
+        # parents are pulled in ahead of their own chunk, and not written again
+        self.assertEquals(sorted(c.pk for c in categories), range(1, 11))
+        self.assertEquals([c.pk for c in categories], range(10, 0, -1))
+        self.assertEquals(seen, set())
+
+    def test_filtered_rows(self):
+        Category.objects.filter(pk=4).update(parent=3)
+        Category.objects.filter(pk=6).update(parent=1)
+        seen = set()
+        categories = list(Command()._iter_objects([Category], chunk_size=2, seen=seen,
+                                                  filters={Category: {'pk__in': [1, 2, 5]}}))
+        # 6 refers back to 1, which was written by the first chunk
+        self.assertEquals(sorted(c.pk for c in categories), [1, 2, 3, 4, 5, 6])
+        # rows outside of the filter are only written as dependencies
+        self.assertEquals(seen, set([(Category, 3), (Category, 4), (Category, 6)]))
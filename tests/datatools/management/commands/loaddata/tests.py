@@ -0,0 +1,338 @@
+import gzip
+import os
+import shutil
+import tempfile
+import zipfile
+from StringIO import StringIO
+
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.utils import simplejson
+from datatools.management.commands import loaddata
+from datatools.management.commands.loaddata import (Command, WorkerError, clear_fixture_index,
+    get_fixture_index, group_fixtures, load_shard)
+from datatools.snapshots import SnapshotCache
+
+
+class LoadDataTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+        group = Group.objects.create(name='staff')
+        group.permissions.add(Permission.objects.get(codename='add_user'))
+        for n in xrange(5):
+            user = User.objects.create(username=n, email='%s@example.com' % n)
+            user.groups.add(group)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def dumpdata(self, name, *args, **options):
+        path = os.path.join(self.path, name)
+        call_command('dumpdata', output=path, *args, **options)
+        return path
+
+    def loaddata(self, *args, **options):
+        options.setdefault('commit', False)
+        options.setdefault('verbosity', 0)
+        call_command('loaddata', stdout=StringIO(), stderr=StringIO(), *args, **options)
+
+    def assertLoaded(self, users):
+        self.assertEquals(list(User.objects.order_by('pk').values_list('pk', 'username', 'email')), users)
+        for user in User.objects.all():
+            self.assertEquals([g.name for g in user.groups.all()], ['staff'])
+        self.assertEquals([p.codename for p in Group.objects.get().permissions.all()], ['add_user'])
+
+    def test_bulk(self):
+        users = list(User.objects.order_by('pk').values_list('pk', 'username', 'email'))
+        path = self.dumpdata('users.json', 'auth.user')
+        User.objects.all().delete()
+        Group.objects.all().delete()
+
+        self.loaddata(path, bulk=True, batch_size=2)
+        self.assertLoaded(users)
+
+    def test_bulk_existing_objects(self):
+        users = list(User.objects.order_by('pk').values_list('pk', 'username', 'email'))
+        path = self.dumpdata('users.json', 'auth.user')
+        User.objects.filter(pk=users[0][0]).update(email='changed@example.com')
+
+        self.loaddata(path, bulk=True)
+        self.assertLoaded(users)
+
+    def test_bulk_without_pk(self):
+        group = Group.objects.get()
+        path = os.path.join(self.path, 'new.json')
+        open(path, 'w').write(simplejson.dumps([
+            {'pk': None, 'model': 'auth.user', 'fields': {'username': name, 'groups': [group.pk],
+             'password': '', 'date_joined': '2012-01-01 00:00:00', 'last_login': '2012-01-01 00:00:00'}}
+            for name in ('new1', 'new2')
+        ]))
+        for engine in ('orm', 'native'):
+            User.objects.filter(username__startswith='new').delete()
+            self.loaddata(path, bulk=True, engine=engine)
+            users = User.objects.filter(username__startswith='new').order_by('username')
+            self.assertEquals([(u.username, [g.name for g in u.groups.all()]) for u in users],
+                              [('new1', ['staff']), ('new2', ['staff'])])
+
+    def test_bulk_natural_keys(self):
+        content_type = ContentType.objects.get_for_model(User)
+        path = os.path.join(self.path, 'natural.json')
+        open(path, 'w').write(simplejson.dumps([
+            {'pk': 999, 'model': 'auth.permission', 'fields': {'codename': 'custom', 'name': 'Custom',
+             'content_type': content_type.pk}},
+            {'pk': 999, 'model': 'auth.group', 'fields': {'name': 'custom',
+             'permissions': [['custom', 'auth', 'user']]}},
+        ]))
+        for options in ({'bulk': True}, {'engine': 'native'}):
+            Permission.objects.filter(codename='custom').delete()
+            Group.objects.filter(name='custom').delete()
+            self.loaddata(path, **options)
+            self.assertEquals([p.pk for p in Group.objects.get(name='custom').permissions.all()], [999])
+
+    def test_native(self):
+        users = list(User.objects.order_by('pk').values_list('pk', 'username', 'email'))
+        path = self.dumpdata('users.json', 'auth.user')
+        User.objects.all().delete()
+        Group.objects.all().delete()
+
+        self.loaddata(path, engine='native', batch_size=2)
+        self.assertLoaded(users)
+
+    def test_native_existing_objects(self):
+        users = list(User.objects.order_by('pk').values_list('pk', 'username', 'email'))
+        path = self.dumpdata('users.json', 'auth.user')
+        User.objects.filter(pk=users[0][0]).update(email='changed@example.com')
+
+        self.loaddata(path, engine='native')
+        self.assertLoaded(users)
+
+    def test_compressed(self):
+        users = list(User.objects.order_by('pk').values_list('pk', 'username', 'email'))
+        path = self.dumpdata('users.json', 'auth.user')
+        fp = gzip.GzipFile(path + '.gz', 'w')
+        fp.write(open(path).read())
+        fp.close()
+        fp = zipfile.ZipFile(path + '.zip', 'w')
+        fp.write(path, 'users.json')
+        fp.close()
+
+        for compression in ('gz', 'zip'):
+            User.objects.all().delete()
+            Group.objects.all().delete()
+            self.loaddata('%s.%s' % (path, compression))
+            self.assertLoaded(users)
+
+    def test_jsonl(self):
+        users = list(User.objects.order_by('pk').values_list('pk', 'username', 'email'))
+        path = self.dumpdata('users.jsonl', 'auth.user', format='jsonl', stream=True)
+        User.objects.all().delete()
+        Group.objects.all().delete()
+
+        self.loaddata(path[:-len('.jsonl')])
+        self.assertLoaded(users)
+
+    def test_cache(self):
+        users = list(User.objects.order_by('pk').values_list('pk', 'username', 'email'))
+        path = self.dumpdata('users.json', 'auth.user')
+        SnapshotCache.memory.clear()
+        User.objects.filter(pk=users[0][0]).update(email='changed@example.com')
+        self.loaddata(path, cache=True)
+        self.assertLoaded(users)
+
+        User.objects.all().delete()
+        Group.objects.all().delete()
+        # a delete and an insert for each of the 7 tables (bar the empty user
+        # permissions), and 9 to check constraints
+        with self.assertNumQueries(22):
+            self.loaddata(path, cache=True)
+        self.assertLoaded(users)
+
+        # snapshots are also kept on disk
+        SnapshotCache.memory.clear()
+        cache = os.path.join(self.path, 'cache')
+        self.loaddata(path, cache=cache)
+        self.assertEquals(len(os.listdir(cache)), 1)
+        SnapshotCache.memory.clear()
+        User.objects.all().delete()
+        self.loaddata(path, cache=cache)
+        self.assertEquals(SnapshotCache.memory.stats()['size'], 1)
+        self.assertLoaded(users)
+
+    def test_cache_without_pk(self):
+        path = os.path.join(self.path, 'new.json')
+        open(path, 'w').write(simplejson.dumps([
+            {'pk': None, 'model': 'auth.user', 'fields': {'username': 'new', 'password': '',
+             'date_joined': '2012-01-01 00:00:00', 'last_login': '2012-01-01 00:00:00'}}
+        ]))
+        SnapshotCache.memory.clear()
+        self.loaddata(path, cache=True)
+        self.assertEquals(SnapshotCache.memory.stats()['size'], 0)
+
+        User.objects.all().delete()
+        User.objects.create(username='someone_else')
+        # loaded again rather than restored over whichever row has the same pk
+        self.loaddata(path, cache=True)
+        self.assertEquals(sorted(User.objects.values_list('username', flat=True)), ['new', 'someone_else'])
+
+    def test_record_range(self):
+        path = self.dumpdata('users.jsonl', 'auth.user', format='jsonl', stream=True)
+        User.objects.all().delete()
+        command = Command()
+        command.setup(database='default', verbosity=0)
+        command.load_file(path, 'jsonl', None, 'default', start=2, stop=4)
+        # records are ordered dependencies first
+        self.assertEquals(list(User.objects.order_by('pk').values_list('username', flat=True)), ['0'])
+        self.assertEquals(command.split_fixture((path, 'jsonl', None), set([User, Group]), 2),
+                          [(path, 'jsonl', None, None, None)])
+
+    def test_parallel_sqlite(self):
+        # loaded in this process, so in-memory databases work too
+        users = list(User.objects.order_by('pk').values_list('pk', 'username', 'email'))
+        path = self.dumpdata('users.json', 'auth.user')
+        User.objects.all().delete()
+        Group.objects.all().delete()
+        self.loaddata(path, jobs=2, commit=True)
+        self.assertLoaded(users)
+
+    def test_group_fixtures(self):
+        fixtures = [set([User]), set([Group]), set([Permission]), set([ContentType]), set([User])]
+        self.assertEquals(group_fixtures(fixtures), [[[3]], [[2]], [[1]], [[0], [4]]])
+        self.assertEquals(group_fixtures([set([User, ContentType]), set([Permission])]), [[[0, 1]]])
+
+
+class ParallelLoadDataTest(TransactionTestCase):
+    # worker processes need connections of their own to a database file
+    multi_db = True
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, data):
+        path = os.path.join(self.path, name)
+        open(path, 'w').write(simplejson.dumps(data))
+        return path
+
+    def loaddata(self, *args, **options):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('loaddata', database='file', jobs=2, stdout=stdout, stderr=stderr, *args, **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_natural_keys_across_files(self):
+        permissions = self.write('permissions.json', [{'pk': None, 'model': 'auth.permission', 'fields': {
+            'codename': 'custom', 'name': 'Custom', 'content_type': ['auth', 'user']}}])
+        groups = self.write('groups.json', [{'pk': None, 'model': 'auth.group', 'fields': {
+            'name': 'custom', 'permissions': [['custom', 'auth', 'user']]}}])
+
+        # content types are only recreated in the default database after a flush, and
+        # natural keys of permissions are always resolved through the default database
+        content_type = ContentType.objects.get_for_model(User)
+        ContentType.objects.db_manager('file').create(pk=content_type.pk, name='user', app_label='auth',
+                                                      model='user')
+        stdout, stderr = self.loaddata(groups, permissions, verbosity=0)
+        self.assertEquals(stderr, '')
+        group = Group.objects.using('file').get(name='custom')
+        self.assertEquals([p.codename for p in group.permissions.all()], ['custom'])
+
+    def test_invalid_model(self):
+        path = self.write('invalid.json', [{'pk': 1, 'model': 'auth.foo', 'fields': {}}])
+        stdout, stderr = self.loaddata(path, verbosity=0)
+        self.assertTrue('Problem installing fixture' in stderr)
+
+    def test_atomic(self):
+        users = self.write('users.json', [{'pk': 1, 'model': 'auth.user', 'fields': {
+            'username': 'valid', 'password': '', 'date_joined': '2012-01-01 00:00:00',
+            'last_login': '2012-01-01 00:00:00'}}])
+        invalid = self.write('invalid.json', [{'pk': 2, 'model': 'auth.user', 'fields': {
+            'username': None, 'password': '', 'date_joined': '2012-01-01 00:00:00',
+            'last_login': '2012-01-01 00:00:00'}}])
+        stdout, stderr = self.loaddata(users, invalid, verbosity=0)
+        self.assertTrue('Problem installing fixture' in stderr)
+        self.assertEquals(User.objects.using('file').count(), 0)
+
+    def test_load_shard(self):
+        path = self.write('users.json', [{'pk': 1, 'model': 'auth.user', 'fields': {
+            'username': 'valid', 'password': '', 'date_joined': '2012-01-01 00:00:00',
+            'last_login': '2012-01-01 00:00:00'}}])
+        options = {'database': 'file', 'verbosity': 0}
+        result = load_shard(([(path, 'json', None, None, None)], options))
+        self.assertEquals(result, {'fixture_object_count': 1, 'loaded_object_count': 1,
+                                   'models': set(['auth.user'])})
+        # failures are rolled back, and raised in a form which can be sent to the parent
+        invalid = self.write('invalid.json', [{'pk': 2, 'model': 'auth.user', 'fields': {
+            'username': None, 'password': '', 'date_joined': '2012-01-01 00:00:00',
+            'last_login': '2012-01-01 00:00:00'}}])
+        files = [(path, 'json', None, None, None), (invalid, 'json', None, None, None)]
+        self.assertRaises(WorkerError, load_shard, (files, options))
+        self.assertEquals(list(User.objects.using('file').values_list('username', flat=True)), ['valid'])
+
+    def test_record_ranges(self):
+        User.objects.db_manager('file').bulk_create([
+            User(username=n, email='%s@example.com' % n, password='') for n in xrange(2000)])
+        users = list(User.objects.using('file').order_by('pk').values_list('pk', 'username'))
+        path = os.path.join(self.path, 'users.jsonl')
+        call_command('dumpdata', 'auth.user', database='file', format='jsonl', stream=True, output=path)
+        User.objects.using('file').delete()
+
+        fixture = (path, 'jsonl', None)
+        self.assertEquals(Command().split_fixture(fixture, set([User]), 2),
+                          [fixture + (0, 1000), fixture + (1000, 2000)])
+        stdout, stderr = self.loaddata(path, bulk=True, verbosity=0)
+        self.assertEquals(stderr, '')
+        self.assertEquals(list(User.objects.using('file').order_by('pk').values_list('pk', 'username')), users)
+
+
+class FixtureIndexTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        clear_fixture_index()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        clear_fixture_index()
+
+    def test_index(self):
+        open(os.path.join(self.path, 'users.json'), 'w').close()
+        os.mkdir(os.path.join(self.path, 'users.jsonl'))
+        self.assertEquals(get_fixture_index(self.path), frozenset(['users.json']))
+        self.assertEquals(get_fixture_index(os.path.join(self.path, 'missing')), frozenset())
+
+        # the directory isn't listed again until it changes
+        path = os.path.join(self.path, 'groups.json')
+        open(path, 'w').close()
+        os.utime(self.path, (0, 0))
+        self.assertEquals(get_fixture_index(self.path), frozenset(['users.json', 'groups.json']))
+        os.unlink(path)
+        os.utime(self.path, (0, 0))
+        self.assertEquals(get_fixture_index(self.path), frozenset(['users.json', 'groups.json']))
+        clear_fixture_index()
+        self.assertEquals(get_fixture_index(self.path), frozenset(['users.json']))
+
+    def test_find_fixtures(self):
+        open(os.path.join(self.path, 'users.json'), 'w').close()
+        command = Command()
+        command.setup(database='default', verbosity=0)
+        calls = []
+
+        def get_index(directory):
+            calls.append(directory)
+            return get_fixture_index(directory)
+
+        loaddata.get_fixture_index = get_index
+        try:
+            fixtures = command.find_fixtures(os.path.join(self.path, 'users'), 'default')
+            # one lookup per directory, not per candidate name
+            self.assertEquals(calls, [self.path])
+            self.assertEquals(fixtures, [(os.path.join(self.path, 'users'), os.path.join(self.path, 'users'),
+                                          [(os.path.join(self.path, 'users.json'), 'json', None)])])
+
+            del calls[:]
+            fixtures = command.find_fixtures('users', 'default')
+            self.assertEquals(len(calls), len(fixtures))
+        finally:
+            loaddata.get_fixture_index = get_fixture_index
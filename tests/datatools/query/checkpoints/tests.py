@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from django.test import TestCase
+from datatools.query.checkpoints import FileCheckpointStore, CacheCheckpointStore
+
+
+class FileCheckpointStoreTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_store(self):
+        store = FileCheckpointStore(os.path.join(self.path, 'checkpoint'))
+        self.assertEquals(store.get(), None)
+        store.set((datetime(2012, 1, 1), 1, 5))
+        self.assertEquals(store.get(), (datetime(2012, 1, 1), 1, 5))
+        self.assertEquals(os.listdir(self.path), ['checkpoint'])
+        store.delete()
+        self.assertEquals(store.get(), None)
+
+    def test_timeout(self):
+        store = CacheCheckpointStore('checkpoint')
+        calls = []
+        store.cache.set = lambda key, value, timeout: calls.append(timeout)
+        store.set((1, 1, 5))
+        self.assertEquals(calls, [60 * 60 * 24 * 7])
+
+        store = CacheCheckpointStore('checkpoint', timeout=60)
+        store.cache.set = lambda key, value, timeout: calls.append(timeout)
+        store.set((1, 1, 5))
+        self.assertEquals(calls[-1], 60)
+        store.delete()
+
+
+class CacheCheckpointStoreTest(TestCase):
+    def test_store(self):
+        store = CacheCheckpointStore('checkpoint')
+        self.assertEquals(store.get(), None)
+        store.set((1, 1, 5))
+        self.assertEquals(store.get(), (1, 1, 5))
+        store.delete()
+        self.assertEquals(store.get(), None)
+
+    def test_timeout(self):
+        store = CacheCheckpointStore('checkpoint')
+        calls = []
+        store.cache.set = lambda key, value, timeout: calls.append(timeout)
+        store.set((1, 1, 5))
+        self.assertEquals(calls, [60 * 60 * 24 * 7])
+
+        store = CacheCheckpointStore('checkpoint', timeout=60)
+        store.cache.set = lambda key, value, timeout: calls.append(timeout)
+        store.set((1, 1, 5))
+        self.assertEquals(calls[-1], 60)
@@ -1,8 +1,13 @@
 import sys
 
-from django.contrib.auth.models import User
-from django.test import TestCase
-from datatools.query.range import RangeQuerySetWrapper
+from django.contrib.auth.models import User, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from datatools.query.checkpoints import CacheCheckpointStore
+from datatools.query.range import RangeQuerySetWrapper, PartitionedRangeQuerySetWrapper, InvalidQuerySetError, \
+  iter_threaded
+from datatools.utils import LRUCache
 
 
 class QueryTest(TestCase):
@@ -82,3 +87,242 @@ class QueryTest(TestCase):
                 seen.add(n.id)
                 self.assertTrue(n.id < last)
                 last = n.id
+
+    def test_reverse_max_id(self):
+        for n in xrange(3, 15):
+            User.objects.create(username=n, email='%s@example.com' % n)
+        ids = sorted(User.objects.values_list('id', flat=True), reverse=True)
+        results = RangeQuerySetWrapper(User.objects.all(), step=-5, max_id=ids[2])
+        self.assertEquals([n.id for n in results], ids[2:])
+
+    def test_order_by_duplicates(self):
+        for n in xrange(3, 10):
+            User.objects.create(username=n, email='%s@example.com' % n)
+        User.objects.update(date_joined=User.objects.all()[0].date_joined)
+
+        # one seek per row + 1 for empty result set, regardless of duplicates
+        with self.assertNumQueries(11):
+            results = list(RangeQuerySetWrapper(User.objects.all(), step=1, order_by='date_joined'))
+        self.assertEquals([n.id for n in results], sorted(User.objects.values_list('id', flat=True)))
+
+        results = list(RangeQuerySetWrapper(User.objects.all(), step=-3, order_by='date_joined'))
+        self.assertEquals([n.id for n in results], sorted(User.objects.values_list('id', flat=True), reverse=True))
+
+    def test_order_by_non_unique(self):
+        for n in xrange(3, 10):
+            User.objects.create(username=n, email='%s@example.com' % (n % 2))
+
+        seen = []
+        for n in RangeQuerySetWrapper(User.objects.all(), step=2, order_by='email'):
+            seen.append((n.email, n.id))
+        self.assertEquals(seen, sorted(User.objects.values_list('email', 'id')))
+
+
+class PartitionedQueryTest(TestCase):
+    def setUp(self):
+        for n in xrange(10):
+            User.objects.create(username=n, email='%s@example.com' % n)
+
+    def test_partitions(self):
+        ids = sorted(User.objects.values_list('id', flat=True))
+        partitions = PartitionedRangeQuerySetWrapper(User.objects.all(), partitions=3, step=2).get_partitions()
+        self.assertEquals(len(partitions), 3)
+        self.assertEquals(partitions[0].min_value, ids[0])
+        self.assertEquals(partitions[-1].max_value, ids[-1])
+        self.assertEquals([n.id for p in partitions for n in p], ids)
+
+    def test_no_results(self):
+        self.assertEquals(PartitionedRangeQuerySetWrapper(User.objects.filter(id=9000)).get_partitions(), [])
+
+    def test_values_list(self):
+        ids = sorted(User.objects.values_list('id', flat=True))
+        partitions = PartitionedRangeQuerySetWrapper(User.objects.values_list('id', flat=True), partitions=2).get_partitions()
+        self.assertEquals([n for p in partitions for n in p], ids)
+
+
+class ThreadedQueryTest(TransactionTestCase):
+    # sqlite's in memory databases are private to each connection
+    multi_db = True
+
+    def setUp(self):
+        for n in xrange(10):
+            User.objects.db_manager('file').create(username=n, email='%s@example.com' % n)
+        self.ids = sorted(User.objects.using('file').values_list('id', flat=True))
+
+    def test_prefetch(self):
+        wrapper = RangeQuerySetWrapper(User.objects.using('file'), step=3, prefetch=2)
+        self.assertEquals([n.id for n in wrapper], self.ids)
+
+    def test_partitioned(self):
+        wrapper = PartitionedRangeQuerySetWrapper(User.objects.using('file'), partitions=3, step=2)
+        self.assertEquals(sorted(n.id for n in wrapper), self.ids)
+
+    def test_managed_transaction(self):
+        transaction.enter_transaction_management(using='file')
+        transaction.managed(True, using='file')
+        try:
+            user = User.objects.db_manager('file').create(username='uncommitted')
+            ids = self.ids + [user.id]
+            wrapper = RangeQuerySetWrapper(User.objects.using('file'), step=3, prefetch=2)
+            self.assertEquals([n.id for n in wrapper], ids)
+            wrapper = PartitionedRangeQuerySetWrapper(User.objects.using('file'), partitions=3, step=2)
+            self.assertEquals(sorted(n.id for n in wrapper), ids)
+        finally:
+            transaction.rollback(using='file')
+            transaction.leave_transaction_management(using='file')
+
+
+class IterThreadedTest(TestCase):
+    def test_order(self):
+        self.assertEquals(list(iter_threaded([iter(xrange(10))], 2, 'default')), range(10))
+
+    def test_multiple(self):
+        self.assertEquals(sorted(iter_threaded([xrange(5), xrange(5, 10)], 1, 'default')), range(10))
+
+    def test_exception(self):
+        def fail():
+            yield 1
+            raise ValueError
+
+        self.assertRaises(ValueError, list, iter_threaded([fail()], 1, 'default'))
+
+    def test_close(self):
+        items = iter_threaded([iter(xrange(100))], 1, 'default')
+        self.assertEquals(items.next(), 0)
+        items.close()
+
+
+class ValuesQueryTest(TestCase):
+    def setUp(self):
+        for n in xrange(5):
+            User.objects.create(username=n, email='%s@example.com' % (n % 2))
+
+    def test_values_list(self):
+        expected = list(User.objects.order_by('id').values_list('id', 'username'))
+        self.assertEquals(list(RangeQuerySetWrapper(User.objects.values_list('id', 'username'), step=2)), expected)
+        self.assertEquals(list(RangeQuerySetWrapper(User.objects.all(), step=2, fields=['id', 'username'])), expected)
+
+    def test_values_list_missing_cursor(self):
+        expected = list(User.objects.order_by('email', 'id').values_list('username', flat=True))
+        results = RangeQuerySetWrapper(User.objects.values_list('username', flat=True), step=2, order_by='email')
+        self.assertEquals(list(results), expected)
+
+    def test_values(self):
+        expected = list(User.objects.order_by('-id').values('username'))
+        self.assertEquals(list(RangeQuerySetWrapper(User.objects.values('username'), step=-2)), expected)
+        self.assertEquals(len(list(RangeQuerySetWrapper(User.objects.values(), step=2))), 5)
+
+    def test_select_related(self):
+        self.assertRaises(InvalidQuerySetError, RangeQuerySetWrapper, User.objects.values(), select_related=['foo'])
+
+
+class AdaptiveQueryTest(TestCase):
+    def setUp(self):
+        for n in xrange(10):
+            User.objects.create(username=n, email='%s@example.com' % n)
+
+    def test_grow(self):
+        ids = sorted(User.objects.values_list('id', flat=True))
+        # steps of 1, 2, 4 and 8 + 1 for empty result set
+        with self.assertNumQueries(5):
+            results = list(RangeQuerySetWrapper(User.objects.all(), step=1, target_time=3600))
+        self.assertEquals([n.id for n in results], ids)
+
+        # steps of 1, 2, 2, 2, 2 and 2 + 1 for empty result set
+        with self.assertNumQueries(7):
+            results = list(RangeQuerySetWrapper(User.objects.all(), step=1, target_time=3600, max_step=2))
+        self.assertEquals([n.id for n in results], ids)
+
+    def test_shrink(self):
+        ids = sorted(User.objects.values_list('id', flat=True), reverse=True)
+        # steps of 4, 2, 2 and 2 + 1 for empty result set
+        with self.assertNumQueries(5):
+            results = list(RangeQuerySetWrapper(User.objects.all(), step=-4, target_time=1e-9, min_step=2))
+        self.assertEquals([n.id for n in results], ids)
+
+
+class CheckpointQueryTest(TestCase):
+    def setUp(self):
+        for n in xrange(5):
+            User.objects.create(username=n, email='%s@example.com' % n)
+        self.ids = sorted(User.objects.values_list('id', flat=True))
+
+    def test_resume(self):
+        results = RangeQuerySetWrapper(User.objects.all(), step=2)
+        self.assertEquals(results.checkpoint, None)
+        seen = []
+        for n in results:
+            seen.append(n.id)
+            if len(seen) == 3:
+                break
+        # the second chunk was not consumed entirely, so it will be repeated
+        self.assertEquals(seen, self.ids[:3])
+        resumed = RangeQuerySetWrapper(User.objects.all(), step=2, resume_from=results.checkpoint)
+        self.assertEquals([n.id for n in resumed], self.ids[2:])
+
+    def test_iterate_twice(self):
+        results = RangeQuerySetWrapper(User.objects.all(), step=2)
+        self.assertEquals([n.id for n in results], self.ids)
+        self.assertEquals([n.id for n in results], self.ids)
+
+        resumed = RangeQuerySetWrapper(User.objects.all(), step=2, resume_from=results.checkpoint)
+        self.assertEquals([n.id for n in resumed], [])
+        self.assertEquals([n.id for n in resumed], [])
+
+    def test_resume_limit(self):
+        results = RangeQuerySetWrapper(User.objects.all()[:3], step=2)
+        chunks = results._iter_chunks()
+        chunk, checkpoint = chunks.next()
+        self.assertEquals([n.id for n in chunk], self.ids[:2])
+        resumed = RangeQuerySetWrapper(User.objects.all()[:3], step=2, resume_from=checkpoint)
+        self.assertEquals([n.id for n in resumed], self.ids[2:3])
+
+    def test_store(self):
+        store = CacheCheckpointStore('range-checkpoint')
+        seen = []
+        for n in RangeQuerySetWrapper(User.objects.all(), step=2, checkpoint_store=store):
+            seen.append(n.id)
+            if len(seen) == 4:
+                break
+        # only the first chunk had been consumed entirely
+        self.assertEquals(store.get()[0], self.ids[1])
+
+        results = RangeQuerySetWrapper(User.objects.all(), step=2, checkpoint_store=store)
+        self.assertEquals([n.id for n in results], self.ids[2:])
+        self.assertEquals(store.get(), None)
+
+
+class SelectRelatedQueryTest(TestCase):
+    def test_foreignkey(self):
+        permissions = Permission.objects.order_by('id').select_related('content_type')
+        expected = [(p.id, p.content_type.model) for p in permissions]
+        num_types = len(set(p.content_type_id for p in permissions))
+        # one query per permission + 1 for empty result set, and every content type
+        # once as they're shared by neighbouring chunks
+        with self.assertNumQueries(len(permissions) + 1 + num_types):
+            results = list(RangeQuerySetWrapper(Permission.objects.all(), step=1, select_related=['content_type']))
+        with self.assertNumQueries(0):
+            self.assertEquals([(p.id, p.content_type.model) for p in results], expected)
+
+    def test_reverse_foreignkey(self):
+        path = 'permission_set__content_type__permission_set'
+        # 2 chunk queries, and one for each reverse relation
+        with self.assertNumQueries(4):
+            results = list(RangeQuerySetWrapper(ContentType.objects.all(), select_related=[path]))
+        expected = dict((c.id, sorted(c.permission_set.values_list('id', flat=True))) for c in results)
+        with self.assertNumQueries(0):
+            for content_type in results:
+                permissions = list(content_type.permission_set.all())
+                self.assertEquals(sorted(p.id for p in permissions), expected[content_type.id])
+                for permission in permissions:
+                    self.assertEquals(permission.content_type, content_type)
+                    self.assertEquals(len(permission.content_type.permission_set.all()), len(permissions))
+
+    def test_cache(self):
+        cache = LRUCache()
+        list(RangeQuerySetWrapper(Permission.objects.all(), step=2, select_related=['content_type'], cache=cache))
+        # one query per chunk + 1 for empty result set
+        with self.assertNumQueries(Permission.objects.count() / 2 + 1):
+            results = list(RangeQuerySetWrapper(Permission.objects.all(), step=2, select_related=['content_type'],
+                                                cache=cache))
+        self.assertTrue(all(p.content_type.id == p.content_type_id for p in results))
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from datatools.compression import CompressedWriter
+from datatools.records import MappedFile, RecordIndex, get_record_index, open_records, split_records
+
+
+class MappedFileTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_read(self):
+        path = os.path.join(self.path, 'data')
+        open(path, 'w').write('abc\ndef\nghi')
+        fixture = MappedFile(path)
+        self.assertEquals(fixture.readline(), 'abc\n')
+        self.assertEquals(fixture.read(2), 'de')
+        self.assertEquals(list(fixture), ['f\n', 'ghi'])
+        self.assertEquals(fixture.read(), '')
+        fixture.close()
+
+        fixture = MappedFile(path, 'r', 4, 9)
+        self.assertEquals(fixture.read(), 'def\ng')
+        fixture.close()
+
+    def test_empty(self):
+        path = os.path.join(self.path, 'empty')
+        open(path, 'w').close()
+        fixture = MappedFile(path)
+        self.assertEquals(fixture.read(), '')
+        self.assertEquals(fixture.readline(), '')
+        fixture.close()
+
+
+class RecordIndexTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.lines = ['{"pk": %d}\n' % n for n in xrange(100)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read(self, path, compression, start=0, stop=None):
+        fixture = open_records(path, compression, start, stop)
+        try:
+            return list(iter(fixture.readline, ''))
+        finally:
+            fixture.close()
+
+    def test_uncompressed(self):
+        path = os.path.join(self.path, 'data.jsonl')
+        open(path, 'w').write('\n  \n'.join(self.lines[:3]))
+        index = RecordIndex.build(path)
+        self.assertEquals(list(index.offsets), [0, 14, 28])
+        self.assertEquals(index.get_offset(3), os.path.getsize(path))
+
+    def test_gzip(self):
+        path = os.path.join(self.path, 'data.jsonl.gz')
+        out = CompressedWriter(open(path, 'wb'), 'gz', block_size=100, threads=2)
+        for line in self.lines:
+            out.write(line)
+        out.close()
+
+        index = get_record_index(path, 'gz')
+        self.assertEquals(len(index), 100)
+        self.assertTrue(len(index.members) > 1)
+        self.assertEquals(self.read(path, 'gz', 42, 50), self.lines[42:50])
+        self.assertEquals(self.read(path, 'gz', 95), self.lines[95:])
+
+    def test_cached(self):
+        path = os.path.join(self.path, 'data.jsonl')
+        open(path, 'w').write(''.join(self.lines))
+        self.assertEquals(len(get_record_index(path)), 100)
+        self.assertTrue(os.path.exists(path + '.idx'))
+        self.assertEquals(self.read(path, None, 10, 12), self.lines[10:12])
+
+        # the index is rebuilt once the file changes
+        open(path, 'w').write(''.join(self.lines[:10]))
+        os.utime(path, (0, 0))
+        self.assertEquals(len(get_record_index(path)), 10)
+
+    def test_split_records(self):
+        self.assertEquals(split_records(5000, 3), [(0, 1667), (1667, 3334), (3334, 5000)])
+        self.assertEquals(split_records(1500, 3), [(0, 1500)])
+        self.assertEquals(split_records(0, 3), [(0, 0)])
@@ -0,0 +1,51 @@
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core import serializers
+from django.core.serializers.base import DeserializationError
+from django.test import TestCase
+from django.utils import simplejson
+from datatools.serializers.json import Deserializer, Serializer, iter_array
+
+
+class IterArrayTest(TestCase):
+    def test_small_buffers(self):
+        data = [{'a': u'\xe9' * 10, 'b': [1, 2, {'c': None}]}, 12345, -1.5e10, 'x', [], {}, True, None]
+        for indent in (None, 2):
+            value = simplejson.dumps(data, indent=indent)
+            for buffer_size in (1, 2, 3, 7, 1024):
+                self.assertEquals(list(iter_array(StringIO(value), buffer_size)), data)
+
+    def test_empty(self):
+        self.assertEquals(list(iter_array(StringIO(' [ ] '))), [])
+
+    def test_invalid(self):
+        for value in ('', '{}', '[1,', '[1 2]', '[1,]', '[{"a": 1'):
+            self.assertRaises(ValueError, list, iter_array(StringIO(value), 2))
+
+    def test_reads_lazily(self):
+        stream = StringIO('[{"a": 1}, ' + 'x' * 100)
+        objects = iter_array(stream, 16)
+        self.assertEquals(objects.next(), {'a': 1})
+        self.assertTrue(stream.tell() < 100)
+
+
+class SerializerTest(TestCase):
+    def setUp(self):
+        for n in xrange(3):
+            User.objects.create(username=n, email='%s@example.com' % n)
+
+    def test_matches_django(self):
+        for indent in (None, 2):
+            data = Serializer().serialize(User.objects.all(), indent=indent)
+            self.assertEquals(simplejson.loads(data),
+                simplejson.loads(serializers.serialize('json', User.objects.all())))
+
+    def test_round_trip(self):
+        data = Serializer().serialize(User.objects.all())
+        objects = [o.object for o in Deserializer(data)]
+        self.assertEquals(objects, list(User.objects.all()))
+        self.assertEquals([o.email for o in objects], [u.email for u in User.objects.all()])
+
+    def test_invalid(self):
+        self.assertRaises(DeserializationError, list, Deserializer('[{"model": "auth.user"'))
@@ -0,0 +1,26 @@
+from django.contrib.auth.models import User
+from django.core import serializers
+from django.test import TestCase
+from django.utils import simplejson
+
+
+class JSONLinesTest(TestCase):
+    def setUp(self):
+        for n in xrange(3):
+            User.objects.create(username=n, email='%s@example.com' % n)
+
+    def test_registered(self):
+        self.assertTrue('jsonl' in serializers.get_public_serializer_formats())
+
+    def test_one_object_per_line(self):
+        data = serializers.serialize('jsonl', User.objects.all(), indent=4)
+        lines = data.splitlines()
+        self.assertEquals(len(lines), 3)
+        self.assertEquals([simplejson.loads(l) for l in lines],
+            simplejson.loads(serializers.serialize('json', User.objects.all())))
+
+    def test_concatenated(self):
+        first = serializers.serialize('jsonl', User.objects.order_by('pk')[:1])
+        rest = serializers.serialize('jsonl', User.objects.order_by('pk')[1:])
+        objects = [o.object for o in serializers.deserialize('jsonl', first + '\n' + rest)]
+        self.assertEquals(objects, list(User.objects.order_by('pk')))
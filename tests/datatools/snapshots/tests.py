@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth.models import Group, Permission
+from django.core import serializers
+from django.test import TestCase
+from datatools.snapshots import LoadedObjects, SnapshotCache, get_file_signature, restore_snapshot, take_snapshot
+
+
+class SnapshotTest(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name='staff')
+        self.group.permissions.add(Permission.objects.get(codename='add_user'))
+
+    def test_restore(self):
+        loaded = LoadedObjects()
+        for obj in serializers.deserialize('json', serializers.serialize('json', [self.group])):
+            loaded.add(obj)
+        snapshot = take_snapshot('default', loaded)
+        self.assertEquals([(table, rows) for table, key, keys, columns, rows in snapshot], [
+            ('auth_group', [(self.group.pk, u'staff')]),
+            ('auth_group_permissions', [(self.group.pk, Permission.objects.get(codename='add_user').pk)]),
+        ])
+
+        self.group.permissions.clear()
+        Group.objects.filter(pk=self.group.pk).update(name='changed')
+        restore_snapshot('default', snapshot)
+        group = Group.objects.get()
+        self.assertEquals(group.name, 'staff')
+        self.assertEquals([p.codename for p in group.permissions.all()], ['add_user'])
+
+    def test_pending(self):
+        loaded = LoadedObjects()
+        for obj in serializers.deserialize('json', '[{"pk": null, "model": "auth.group", "fields": {"name": "new"}}]'):
+            loaded.add(obj)
+        self.assertEquals(take_snapshot('default', loaded), None)
+        # the primary key it's given isn't the fixture's to restore
+        obj.save()
+        self.assertEquals(loaded.get_pks(), None)
+        self.assertEquals(take_snapshot('default', loaded), None)
+
+
+class SnapshotCacheTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        SnapshotCache.memory.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        SnapshotCache.memory.clear()
+
+    def test_cache(self):
+        cache = SnapshotCache(os.path.join(self.path, 'cache'))
+        self.assertEquals(cache.get('a'), None)
+        cache.set('a', [1])
+        SnapshotCache.memory.clear()
+        self.assertEquals(cache.get('a'), [1])
+
+        # values which can't be pickled are only kept in memory
+        cache.set('b', [lambda: None])
+        self.assertEquals(sorted(os.listdir(cache.path)), ['a.snapshot'])
+        self.assertNotEquals(cache.get('b'), None)
+
+    def test_file_signature(self):
+        path = os.path.join(self.path, 'fixture.json')
+        open(path, 'w').write('[]')
+        signature = get_file_signature(path)
+        open(path, 'w').write('[{}]')
+        os.utime(path, (0, 0))
+        self.assertNotEquals(get_file_signature(path), signature)
@@ -0,0 +1,87 @@
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import time
+
+from django.contrib.auth.models import Permission
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+from django.db import connections
+from datatools.utils import LRUCache, attach_foreignkey, dump_atomic, is_in_memory
+
+
+class LRUCacheTest(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(size=2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEquals(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+        self.assertEquals(cache.stats(), {'hits': 3, 'misses': 1, 'size': 2})
+
+    def test_replace(self):
+        cache = LRUCache(size=2)
+        cache['a'] = 1
+        cache['a'] = 2
+        cache['b'] = 3
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get('a'), 2)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache['a'] = 1
+        self.assertTrue('a' in cache)
+        time.sleep(0.02)
+        self.assertFalse('a' in cache)
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(len(cache), 0)
+
+
+class DumpAtomicTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_dump(self):
+        path = os.path.join(self.path, 'value')
+        dump_atomic({'a': 1}, path)
+        dump_atomic({'b': 2}, path)
+        self.assertEquals(pickle.load(open(path, 'rb')), {'b': 2})
+        self.assertEquals(os.listdir(self.path), ['value'])
+
+    def test_unpicklable(self):
+        path = os.path.join(self.path, 'value')
+        dump_atomic({'a': 1}, path)
+        self.assertRaises(pickle.PicklingError, dump_atomic, lambda: None, path)
+        self.assertEquals(pickle.load(open(path, 'rb')), {'a': 1})
+        self.assertEquals(os.listdir(self.path), ['value'])
+
+
+class IsInMemoryTest(TestCase):
+    def test_is_in_memory(self):
+        self.assertTrue(is_in_memory(connections['default']))
+        self.assertFalse(is_in_memory(connections['file']))
+
+
+class AttachForeignKeyTest(TestCase):
+    def test_cache(self):
+        cache = LRUCache()
+        permissions = list(Permission.objects.all())
+        num_types = ContentType.objects.filter(permission__isnull=False).distinct().count()
+        with self.assertNumQueries(1):
+            attach_foreignkey(permissions, Permission.content_type, cache=cache)
+        self.assertEquals(len(cache), num_types)
+
+        permissions = list(Permission.objects.all())
+        with self.assertNumQueries(0):
+            attach_foreignkey(permissions, Permission.content_type, cache=cache)
+            for permission in permissions:
+                self.assertEquals(permission.content_type.id, permission.content_type_id)
+        self.assertEquals(cache.stats(), {'hits': num_types, 'misses': num_types, 'size': num_types})